@@ -1,106 +1,951 @@
-import os
-import subprocess
-import re
-import tempfile
-import shutil
-
-# Map module names to pip package names
-module_to_pip = {
-    'cv2': 'opencv-python',
-    'numpy': 'numpy',
-    'segno': 'segno',
-    'requests': 'requests',
-    'datetime': 'datetime',
-}
-
-python_std_lib_modules = [
-    "__future__", "abc", "aifc", "argparse", "array", "ast", "asynchat", "asyncio", "asyncore", "atexit",
-    "audioop", "base64", "bdb", "binascii", "binhex", "bisect", "builtins", "bz2", "calendar", "cgi",
-    "cgitb", "chunk", "cmath", "cmd", "code", "codecs", "codeop", "collections", "colorsys", "compileall",
-    "concurrent", "configparser", "contextlib", "contextvars", "copy", "copyreg", "crypt", "csv", "ctypes",
-    "curses", "dataclasses", "datetime", "dbm", "decimal", "difflib", "dis", "distutils", "doctest",
-    "email", "encodings", "ensurepip", "enum", "errno", "faulthandler", "fcntl", "filecmp", "fileinput",
-    "fnmatch", "formatter", "fractions", "ftplib", "functools", "gc", "getopt", "getpass", "gettext",
-    "glob", "grp", "gzip", "hashlib", "heapq", "hmac", "html", "http", "imaplib", "imghdr", "importlib",
-    "inspect", "io", "ipaddress", "itertools", "json", "keyword", "lib2to3", "linecache", "locale",
-    "logging", "lzma", "mailbox", "mailcap", "marshal", "math", "mimetypes", "mmap", "modulefinder",
-    "multiprocessing", "netrc", "nis", "nntplib", "numbers", "operator", "optparse", "os", "ossaudiodev",
-    "pathlib", "pdb", "pickle", "pickletools", "pipes", "pkgutil", "platform", "plistlib", "poplib",
-    "posix", "posixpath", "pprint", "profile", "pstats", "pty", "pwd", "py_compile", "pyclbr",
-    "pydoc", "queue", "quopri", "random", "re", "readline", "reprlib", "resource", "rlcompleter",
-    "runpy", "sched", "secrets", "select", "selectors", "shelve", "shlex", "shutil", "signal", "site",
-    "smtpd", "smtplib", "sndhdr", "socket", "socketserver", "sqlite3", "ssl", "stat", "statistics",
-    "string", "stringprep", "struct", "subprocess", "sunau", "symbol", "symtable", "sys", "sysconfig",
-    "syslog", "tabnanny", "tarfile", "telnetlib", "tempfile", "termios", "textwrap", "threading",
-    "time", "timeit", "tkinter", "token", "tokenize", "trace", "traceback", "tracemalloc", "tty",
-    "turtle", "turtledemo", "types", "typing", "unicodedata", "unittest", "urllib", "uuid",
-    "venv", "warnings", "wave", "weakref", "webbrowser", "winreg", "winsound", "wsgiref", "xdrlib",
-    "xml", "xmlrpc", "zipapp", "zipfile", "zipimport", "zlib", "zoneinfo"
-]
-
-def detectReqs(path):
-    reqs = []
-    fileTxt = ""
-    with open(path, 'r',encoding="utf-8") as f:
-        fileTxt = f.read()
-    pattern = re.compile(r"import (.*?)\n")
-    for match in re.finditer(pattern, fileTxt):
-        name = match.group(1)
-
-        # Handle 'import X as Y' case
-        if ' as ' in name:
-            name = name.split(' as ')[0]
-
-        topModule = name.split(".")[0]
-        if topModule in python_std_lib_modules:
-            continue
-        reqs.append(topModule)
-    return reqs
-
-pkgs = []
-for path in os.listdir("./pkgs"):
-    pathName = path.split(".")[0]
-    absPath = os.path.abspath(os.path.join("./pkgs",path))
-
-    if not absPath.endswith(".py"):
-        continue
-
-    # Get required modules
-    modules = detectReqs(absPath)
-
-    # Map modules to pip packages
-    reqs = []
-    for module in modules:
-        if module in module_to_pip:
-            reqs.append(module_to_pip[module])
-        else:
-            reqs.append(module)
-
-    # Add PyInstaller
-    reqs.append("pyinstaller")
-
-    with tempfile.TemporaryDirectory(delete=True) as venv:
-        subprocess.run(["python3", "-m", "venv", venv])
-
-        # Determine the correct paths based on the operating system
-        if os.name == 'nt':  # Windows
-            pipPath = os.path.join(venv, "Scripts", "pip.exe")
-            pythonPath = os.path.join(venv, "Scripts", "python.exe")
-        else:  # Linux/Mac
-            pipPath = os.path.join(venv, "bin", "pip")
-            pythonPath = os.path.join(venv, "bin", "python")
-
-        subprocess.run([pipPath, "install",*reqs])
-
-        print(os.path.abspath(absPath))
-        print([pythonPath, "-m", "PyInstaller", absPath, "--onefile"])
-        subprocess.run([pythonPath, "-m", "PyInstaller", absPath, "--onefile", "--clean","--target-arch","x86_64"])
-
-        # Remove spec file if it exists
-        spec_file = "./"+pathName+".spec"
-        if os.path.exists(spec_file):
-            os.remove(spec_file)
-    pkgs.append(pathName+".exe")
-
-with open("./dist/registry.txt", "w",encoding="utf-8") as f:
-    f.write("\n".join(pkgs))
+import os
+import sys
+import subprocess
+import ast
+import tempfile
+import shutil
+import time
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import threading
+import contextlib
+import hashlib
+import json
+import gzip
+import struct
+import tarfile
+import statistics
+import datetime
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Binary delta format shared with kpz.py: magic, a JSON header line, then
+# gzip-compressed ops - b"C" + (offset, length) copies from the old file,
+# b"A" + length + bytes adds literal data.
+DELTA_MAGIC = b"KPZDELTA1\n"
+DELTA_BLOCK = 64
+DELTA_MAX_RATIO = 0.5  # Don't publish deltas larger than this fraction of the full artifact
+
+# Compressed copies published next to each artifact, by encoding name
+COMPRESSED_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+COMPRESSION_MIN_RATIO = 1.05
+
+# Fast-start builds: a PyInstaller onedir build packed next to the onefile artifact
+ONEDIR_SUFFIX = ".onedir.tar.gz"
+
+PYINSTALLER_OPTIONS = ["--onefile", "--clean", "--target-arch", "x86_64"]
+BUILD_CACHE_DIR = "./build/cache"
+BUNDLE_NAME = "kpzbox"
+BENCH_FILE = "./dist/bench.json"
+BENCH_TIMEOUT = 60
+BENCH_MIN_DELTA = 0.1  # Start time changes below this many seconds are treated as noise
+ENVS_DIR = "./build/envs"
+WHEEL_DIR = "./build/wheels"
+
+# Multi-call launcher built with --bundle: picks the tool from the name it was
+# started as (a per-tool link) or from its first argument
+BUNDLE_LAUNCHER = """\
+# Generated by compile.py
+import multiprocessing
+import os
+import runpy
+import sys
+
+TOOLS = {tools!r}
+
+def main():
+    multiprocessing.freeze_support()
+    tool = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    if tool not in TOOLS:
+        if len(sys.argv) < 2 or sys.argv[1] not in TOOLS:
+            print("usage: {name} TOOL [ARGS...], or run it through a link named after the tool")
+            print("tools: " + ", ".join(TOOLS))
+            sys.exit(0 if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help") else 2)
+        tool = sys.argv.pop(1)
+    sys.argv[0] = tool
+    runpy.run_module(tool, run_name="__main__")
+
+if __name__ == "__main__":
+    main()
+"""
+
+# Map module names to pip package names
+module_to_pip = {
+    'cv2': 'opencv-python',
+    'numpy': 'numpy',
+    'segno': 'segno',
+    'requests': 'requests',
+    'datetime': 'datetime',
+}
+
+# pip packages that other requirements already install, so listing them would
+# only split otherwise identical build environments
+pip_dependencies = {
+    'requests': ['urllib3', 'idna', 'charset-normalizer', 'certifi'],
+    'opencv-python': ['numpy'],
+}
+
+# Heavy modules PyInstaller bundles because something in the dependency graph
+# can import them, but which are never needed unless the script itself uses
+# them. Keyed by the top-level module that drags them in (None: always checked).
+EXCLUDABLE_MODULES = {
+    None: ["tkinter", "unittest", "doctest", "pdb", "pydoc", "lib2to3", "xmlrpc", "setuptools", "pkg_resources",
+           "distutils"],
+    "numpy": ["numpy.f2py", "numpy.distutils", "numpy.testing", "numpy.typing"],
+}
+
+def analyzeImports(path, seen=None):
+    """
+    Walk a script's AST and collect what it imports and how it uses it.
+
+    Returns a dict with the absolute module names imported ("modules"), the
+    dotted attribute chains used on imported names, resolved to module paths
+    ("attributes", e.g. np.linalg.norm -> numpy.linalg.norm), whether anything
+    is imported dynamically ("dynamic") and the local scripts involved
+    ("local"). Modules imported outside a try/except ImportError are also
+    listed as "required"; the others are optional. Sibling scripts imported as
+    modules are followed and merged in.
+    """
+    seen = set() if seen is None else seen
+    seen.add(os.path.abspath(path))
+    with open(path, 'r', encoding="utf-8") as f:
+        tree = ast.parse(f.read(), filename=path)
+
+    # Imports in a try whose handler catches ImportError are optional dependencies
+    guarded = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Try) and any(catchesImportError(handler.type) for handler in node.handlers):
+            for statement in node.body:
+                guarded |= {id(child) for child in ast.walk(statement)
+                            if isinstance(child, (ast.Import, ast.ImportFrom))}
+
+    modules = set()
+    required = set()
+    aliases = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            if id(node) not in guarded:
+                required |= {alias.name for alias in node.names}
+            for alias in node.names:
+                modules.add(alias.name)
+                # 'import a.b' binds a, 'import a.b as c' binds c to a.b
+                if alias.asname:
+                    aliases[alias.asname] = alias.name
+                else:
+                    aliases[alias.name.split(".")[0]] = alias.name.split(".")[0]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            modules.add(node.module)
+            if id(node) not in guarded:
+                required.add(node.module)
+            for alias in node.names:
+                if alias.name != "*":
+                    # The imported name may be a submodule
+                    modules.add(node.module + "." + alias.name)
+                    aliases[alias.asname or alias.name] = node.module + "." + alias.name
+
+    attributes = set()
+    dynamic = False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute):
+            chain = []
+            base = node
+            while isinstance(base, ast.Attribute):
+                chain.append(base.attr)
+                base = base.value
+            if isinstance(base, ast.Name) and base.id in aliases:
+                attributes.add(".".join([aliases[base.id], *reversed(chain)]))
+        elif isinstance(node, ast.Call):
+            func = node.func
+            name = func.id if isinstance(func, ast.Name) else func.attr if isinstance(func, ast.Attribute) else None
+            if name in ("__import__", "import_module"):
+                if node.args and isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, str):
+                    modules.add(node.args[0].value)
+                    required.add(node.args[0].value)
+                else:
+                    dynamic = True
+
+    result = {"modules": modules, "required": required, "attributes": attributes, "dynamic": dynamic}
+    for module in sorted(modules):
+        local = os.path.join(os.path.dirname(os.path.abspath(path)), module.split(".")[0] + ".py")
+        if os.path.isfile(local) and local not in seen:
+            nested = analyzeImports(local, seen)
+            result["modules"] |= nested["modules"]
+            if module in required:
+                result["required"] |= nested["required"]
+            result["attributes"] |= nested["attributes"]
+            result["dynamic"] = result["dynamic"] or nested["dynamic"]
+    result["local"] = {os.path.splitext(os.path.basename(p))[0] for p in seen}
+    return result
+
+def catchesImportError(handlerType):
+    """Whether an except clause's type (None for a bare except) catches ImportError."""
+    if handlerType is None:
+        return True
+    names = handlerType.elts if isinstance(handlerType, ast.Tuple) else [handlerType]
+    return any(isinstance(name, ast.Name) and name.id in ("ImportError", "ModuleNotFoundError", "Exception")
+               for name in names)
+
+def detectReqs(path):
+    """
+    Top-level third-party modules a script needs; stdlib and local modules are skipped,
+    as are optional ones it only imports inside a try/except ImportError.
+    """
+    analysis = analyzeImports(path)
+    tops = {module.split(".")[0] for module in analysis["required"]}
+    return sorted(top for top in tops if top not in sys.stdlib_module_names and top not in analysis["local"])
+
+def localSources(paths):
+    """The scripts in pkgs/ that the given scripts import, themselves included, as absolute paths."""
+    sources = set()
+    for path in paths:
+        directory = os.path.dirname(os.path.abspath(path))
+        sources |= {os.path.join(directory, name + ".py") for name in analyzeImports(path)["local"]}
+    return sorted(sources)
+
+def excludedModules(path):
+    """Modules from EXCLUDABLE_MODULES the script never touches, for --exclude-module."""
+    analysis = analyzeImports(path)
+    if analysis["dynamic"]:
+        return []
+    used = analysis["modules"] | analysis["attributes"]
+    tops = {name.split(".")[0] for name in used}
+    excludes = []
+    for top, candidates in EXCLUDABLE_MODULES.items():
+        if top is not None and top not in tops:
+            continue
+        for candidate in candidates:
+            if not any(name == candidate or name.startswith(candidate + ".") for name in used):
+                excludes.append(candidate)
+    return sorted(excludes)
+
+def pyinstallerOptions(excludes):
+    return PYINSTALLER_OPTIONS + [option for module in excludes for option in ("--exclude-module", module)]
+
+def writeBundleLauncher(pathName, tools, workDir):
+    """Generate the multi-call launcher script for a bundle of pkgs/ scripts."""
+    launcherPath = os.path.join(workDir, pathName + ".py")
+    source = BUNDLE_LAUNCHER.format(name=pathName, tools=sorted(tool.split(".")[0] for tool in tools))
+    with open(launcherPath, 'w', encoding="utf-8") as f:
+        f.write(source)
+    return launcherPath
+
+def bundleOptions(tools):
+    """PyInstaller options for a bundle: every tool as a module, excluding only what none of them use."""
+    excludes = None
+    for tool in tools:
+        toolExcludes = set(excludedModules(os.path.join("./pkgs", tool)))
+        excludes = toolExcludes if excludes is None else excludes & toolExcludes
+    options = pyinstallerOptions(sorted(excludes or []))
+    options += ["--paths", os.path.abspath("./pkgs")]
+    for tool in sorted(tools):
+        options += ["--hidden-import", tool.split(".")[0]]
+    return options
+
+def fileSha256(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def artifactPath(pathName):
+    # PyInstaller only appends .exe on Windows
+    for candidate in ["./dist/" + pathName + ".exe", "./dist/" + pathName]:
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+def matchLength(old, oldPos, new, newPos):
+    # Gallop forward in large steps first, then narrow down to the exact byte
+    length = 0
+    for step in (1024 * 1024, 64 * 1024, 4096, DELTA_BLOCK, 1):
+        while (newPos + length + step <= len(new) and oldPos + length + step <= len(old)
+               and new[newPos + length:newPos + length + step] == old[oldPos + length:oldPos + length + step]):
+            length += step
+    return length
+
+def computeDeltaOps(oldData, newData):
+    """
+    Find copy/add ops that rebuild newData from oldData.
+
+    Blocks of the old file are indexed at aligned offsets and the new file is
+    scanned byte by byte only where nothing matches, so unchanged regions cost
+    one lookup per matched run. Returns None once the literal data grows past
+    DELTA_MAX_RATIO of the new file, since a full download is cheaper then.
+    """
+    old = memoryview(oldData)
+    new = memoryview(newData)
+    index = {}
+    for offset in range(0, len(old) - DELTA_BLOCK + 1, DELTA_BLOCK):
+        index.setdefault(bytes(old[offset:offset + DELTA_BLOCK]), offset)
+
+    ops = []
+    literalBytes = 0
+    literalStart = 0
+    pos = 0
+    maxLiteral = len(new) * DELTA_MAX_RATIO
+    expectedOld = None
+    while pos + DELTA_BLOCK <= len(new):
+        # Try continuing the previous copy before falling back to the index
+        oldPos = None
+        if expectedOld is not None and expectedOld + DELTA_BLOCK <= len(old) \
+                and new[pos:pos + DELTA_BLOCK] == old[expectedOld:expectedOld + DELTA_BLOCK]:
+            oldPos = expectedOld
+        else:
+            oldPos = index.get(bytes(new[pos:pos + DELTA_BLOCK]))
+
+        if oldPos is None:
+            pos += 1
+            if pos - literalStart + literalBytes > maxLiteral:
+                return None
+            continue
+
+        if pos > literalStart:
+            ops.append(("A", literalStart, pos - literalStart))
+            literalBytes += pos - literalStart
+        length = matchLength(old, oldPos, new, pos)
+        ops.append(("C", oldPos, length))
+        pos += length
+        expectedOld = oldPos + length
+        literalStart = pos
+
+    if literalStart < len(new):
+        ops.append(("A", literalStart, len(new) - literalStart))
+        literalBytes += len(new) - literalStart
+    if literalBytes > maxLiteral:
+        return None
+    return ops
+
+def makeDelta(oldPath, newPath, deltaPath):
+    with open(oldPath, 'rb') as f:
+        oldData = f.read()
+    with open(newPath, 'rb') as f:
+        newData = f.read()
+
+    ops = computeDeltaOps(oldData, newData)
+    if ops is None:
+        return False
+
+    header = {
+        "source_sha256": hashlib.sha256(oldData).hexdigest(),
+        "target_sha256": hashlib.sha256(newData).hexdigest(),
+        "target_size": len(newData),
+    }
+    os.makedirs(os.path.dirname(deltaPath), exist_ok=True)
+    with open(deltaPath, 'wb') as f:
+        f.write(DELTA_MAGIC)
+        f.write(json.dumps(header).encode("utf-8") + b"\n")
+        with gzip.GzipFile(fileobj=f, mode='wb') as body:
+            for kind, offset, length in ops:
+                if kind == "C":
+                    body.write(b"C" + struct.pack(">QQ", offset, length))
+                else:
+                    body.write(b"A" + struct.pack(">Q", length))
+                    body.write(newData[offset:offset + length])
+    return True
+
+def publishDelta(pathName, previousPath):
+    """Publish a delta from the previous release of a package to the one just built."""
+    deltaDir = os.path.join("./dist/deltas", pathName + ".exe")
+    newPath = artifactPath(pathName)
+    if previousPath is None or newPath is None:
+        return
+
+    oldSha = fileSha256(previousPath)
+    if oldSha == fileSha256(newPath):
+        return
+
+    # Deltas from older releases would now produce a stale binary
+    if os.path.isdir(deltaDir):
+        shutil.rmtree(deltaDir)
+
+    deltaPath = os.path.join(deltaDir, oldSha + ".delta")
+    if makeDelta(previousPath, newPath, deltaPath):
+        fullSize = os.path.getsize(newPath)
+        deltaSize = os.path.getsize(deltaPath)
+        print(f"Published delta for {pathName}: {deltaSize} bytes ({deltaSize / fullSize:.1%} of {fullSize})")
+    else:
+        print(f"Skipped delta for {pathName}: too different from the previous release")
+
+def publishCompressed(pathName):
+    """Publish gzip (and zstd, if available) copies of an artifact for kpz to download."""
+    path = artifactPath(pathName)
+    if path is None:
+        return
+
+    fullSize = os.path.getsize(path)
+    for encoding, suffix in COMPRESSED_SUFFIXES.items():
+        target = "./dist/" + pathName + ".exe" + suffix
+        if encoding == "zstd" and zstandard is None:
+            if os.path.exists(target):
+                os.remove(target)
+            continue
+
+        with open(path, 'rb') as src, open(target + ".tmp", 'wb') as dst:
+            if encoding == "gzip":
+                with gzip.GzipFile(fileobj=dst, mode='wb', compresslevel=9, mtime=0) as out:
+                    shutil.copyfileobj(src, out, 1024 * 1024)
+            else:
+                zstandard.ZstdCompressor(level=19, threads=-1).copy_stream(src, dst)
+        size = os.path.getsize(target + ".tmp")
+        if fullSize / max(size, 1) < COMPRESSION_MIN_RATIO:
+            # Not worth the decompression on the client
+            os.remove(target + ".tmp")
+            if os.path.exists(target):
+                os.remove(target)
+            continue
+        os.replace(target + ".tmp", target)
+        print(f"Published {encoding} copy of {pathName}: {size} bytes (ratio {fullSize / size:.2f}x)")
+
+def publishedEncodings(package):
+    encodings = {}
+    for encoding, suffix in COMPRESSED_SUFFIXES.items():
+        path = "./dist/" + package + suffix
+        if os.path.isfile(path):
+            encodings[encoding] = {"path": package + suffix, "size": os.path.getsize(path), "sha256": fileSha256(path)}
+    return encodings
+
+def onedirArchivePath(pathName):
+    return "./dist/" + pathName + ".exe" + ONEDIR_SUFFIX
+
+def packOnedir(pathName, distDir):
+    """Pack the onedir build in distDir into dist/<name>.exe.onedir.tar.gz, reproducibly."""
+    def normalize(info):
+        info.mtime = 0
+        info.uid = info.gid = 0
+        info.uname = info.gname = ""
+        return info
+
+    archivePath = onedirArchivePath(pathName)
+    tmpPath = archivePath + ".tmp"
+    with open(tmpPath, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as gz, \
+            tarfile.open(fileobj=gz, mode="w") as tar:
+        tar.add(os.path.join(distDir, pathName), arcname=pathName, filter=normalize)
+    os.replace(tmpPath, archivePath)
+
+def publishedOnedir(package):
+    path = onedirArchivePath(package[:-len(".exe")])
+    if not os.path.isfile(path):
+        return None
+    return {"path": os.path.basename(path), "size": os.path.getsize(path), "sha256": fileSha256(path)}
+
+def publishedDeltas(package):
+    deltaDir = os.path.join("./dist/deltas", package)
+    if not os.path.isdir(deltaDir):
+        return []
+    return sorted(name[:-len(".delta")] for name in os.listdir(deltaDir) if name.endswith(".delta"))
+
+def writeManifest(pkgs, manifestPath="./dist/manifest.json", provides=None):
+    """
+    Write the JSON manifest kpz uses to list, verify and skip packages.
+
+    Versions are bumped only when a package's SHA-256 changes, so rebuilding
+    an unchanged package keeps its version and build time. provides maps
+    multi-call bundles to the packages they contain.
+    """
+    previous = {}
+    if os.path.exists(manifestPath):
+        with open(manifestPath, 'r', encoding="utf-8") as f:
+            previous = json.load(f).get("packages", {})
+
+    packages = {}
+    for package in pkgs:
+        path = artifactPath(package[:-len(".exe")])
+        if path is None:
+            continue
+
+        sha = fileSha256(path)
+        entry = dict(previous.get(package, {}))
+        if entry.get("sha256") != sha:
+            entry = {
+                "version": entry.get("version", 0) + 1,
+                "built_at": datetime.datetime.fromtimestamp(os.path.getmtime(path), datetime.timezone.utc).isoformat(),
+            }
+        entry.update({
+            "size": os.path.getsize(path),
+            "sha256": sha,
+            "deltas": publishedDeltas(package),
+            "encodings": publishedEncodings(package),
+        })
+        onedir = publishedOnedir(package)
+        if onedir:
+            entry["onedir"] = onedir
+        else:
+            entry.pop("onedir", None)
+        if provides and package in provides:
+            entry["provides"] = provides[package]
+        else:
+            entry.pop("provides", None)
+        packages[package] = entry
+
+    if packages == previous:
+        # Unchanged manifests keep their timestamp, so clients revalidating it get a 304
+        return
+
+    manifest = {
+        "generated_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "packages": packages,
+    }
+    tmpPath = manifestPath + ".tmp"
+    with open(tmpPath, 'w', encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmpPath, manifestPath)
+
+def runLogged(cmd, log, env=None):
+    """Run a build step with its output appended to the package's build log."""
+    log.write(f"$ {' '.join(cmd)}\n")
+    log.flush()
+    return subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT, env=env).returncode == 0
+
+def packageRequirements(absPath):
+    """pip requirements needed to build one script, including PyInstaller."""
+    # Map modules to pip packages
+    reqs = []
+    for module in detectReqs(absPath):
+        if module in module_to_pip:
+            reqs.append(module_to_pip[module])
+        else:
+            reqs.append(module)
+
+    # Add PyInstaller
+    reqs.append("pyinstaller")
+    # Drop what another requirement installs anyway, so e.g. requests and requests + urllib3 share an env
+    provided = {dependency for req in reqs for dependency in pip_dependencies.get(req, [])}
+    return sorted(set(reqs) - provided)
+
+def envKey(reqs, pythonVersion):
+    """Name of the shared build environment for a requirement set."""
+    key = {"requirements": sorted(set(reqs)), "python": pythonVersion}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def envTools(envDir):
+    # Determine the correct paths based on the operating system
+    if os.name == 'nt':  # Windows
+        return os.path.join(envDir, "Scripts", "pip.exe"), os.path.join(envDir, "Scripts", "python.exe")
+    return os.path.join(envDir, "bin", "pip"), os.path.join(envDir, "bin", "python")  # Linux/Mac
+
+def prepareEnv(reqs, pythonVersion, refresh=False, downloadLock=None):
+    """
+    Create, or reuse, the persistent build venv for a requirement set.
+
+    Environments live in build/envs/<key> and are shared by every package with
+    the same requirements. Wheels are collected in build/wheels and installed
+    with --no-index; the index is only used when the cache is missing something
+    (or refresh is set), so once it is filled environments are created offline. The installed set (pip freeze) is stored in the env's
+    stamp file and feeds the build keys. Returns (ok, env, reused).
+    """
+    envDir = os.path.abspath(os.path.join(ENVS_DIR, envKey(reqs, pythonVersion)))
+    stampPath = os.path.join(envDir, "kpz-env.json")
+    pipPath, pythonPath = envTools(envDir)
+    if not refresh and os.path.exists(stampPath) and os.path.exists(pythonPath):
+        try:
+            with open(stampPath, 'r', encoding="utf-8") as f:
+                return True, json.load(f), True
+        except (OSError, ValueError):
+            pass
+
+    if os.path.exists(envDir):
+        shutil.rmtree(envDir)
+    wheelDir = os.path.abspath(WHEEL_DIR)
+    os.makedirs(wheelDir, exist_ok=True)
+    with open(envDir + ".log", "w", encoding="utf-8") as log:
+        ok = runLogged(["python3", "-m", "venv", envDir], log)
+        offlineInstall = [pipPath, "install", "--no-index", "--find-links", wheelDir, *reqs]
+        # Only go to the index when the wheel cache can't satisfy reqs (or newer wheels were asked for)
+        if ok and (refresh or not runLogged(offlineInstall, log)):
+            with downloadLock or contextlib.nullcontext():
+                runLogged([pipPath, "wheel", "--wheel-dir", wheelDir, "--find-links", wheelDir, *reqs], log)
+            ok = runLogged(offlineInstall, log)
+
+    env = {"path": envDir, "declared": sorted(set(reqs)), "python": pythonVersion, "requirements": []}
+    if ok:
+        freeze = subprocess.run([pipPath, "freeze"], capture_output=True, text=True)
+        env["requirements"] = sorted(line.strip().lower() for line in freeze.stdout.splitlines() if line.strip())
+        with open(stampPath, 'w', encoding="utf-8") as f:
+            json.dump(env, f, indent=2, sort_keys=True)
+    return ok, env, False
+
+def buildKey(absPath, resolved, pythonVersion, options, bundled=()):
+    """Hash everything that affects a package's artifact."""
+    key = {
+        "source": fileSha256(absPath),
+        "requirements": resolved,
+        "python": pythonVersion,
+        "pyinstaller_options": options,
+    }
+    if bundled:
+        key["bundled_sources"] = {os.path.basename(path): fileSha256(path) for path in bundled}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+def loadBuildCache(pathName):
+    try:
+        with open(os.path.join(BUILD_CACHE_DIR, pathName + ".json"), 'r', encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def saveBuildCache(pathName, entry):
+    os.makedirs(BUILD_CACHE_DIR, exist_ok=True)
+    with open(os.path.join(BUILD_CACHE_DIR, pathName + ".json"), 'w', encoding="utf-8") as f:
+        json.dump(entry, f, indent=2, sort_keys=True)
+
+def buildPackage(path, env, pythonVersion, force=False, bundle=None, onedir=False):
+    """
+    Build one script from pkgs/ into dist/ and publish its delta and compressed copies.
+
+    With bundle (a list of pkgs/ scripts) path names a multi-call executable
+    instead, built from a generated launcher that contains all of them.
+    With onedir a fast-start onedir build is also made and packed into an
+    archive, which kpz unpacks once instead of the executable unpacking
+    itself on every run.
+
+    Runs in a worker process using the shared build environment prepared by
+    main(), so everything PyInstaller writes (work dir, spec file, config/cache
+    dir) is kept per package under build/<name>/, and the tool output goes to
+    build/<name>/build.log instead of the console.
+    The build is skipped if the source, installed dependencies, Python version
+    and PyInstaller options match the cached build and its artifact is unchanged.
+    Returns the package name, whether the build succeeded or was cached, and per-step timings.
+    """
+    pathName = path.split(".")[0]
+    workDir = os.path.abspath(os.path.join("./build", pathName))
+    os.makedirs(workDir, exist_ok=True)
+    timings = {}
+    started = time.monotonic()
+
+    if env is None:
+        with open(os.path.join(workDir, "build.log"), "w", encoding="utf-8") as log:
+            log.write("Build environment could not be prepared, see build/envs/*.log\n")
+        timings["total"] = time.monotonic() - started
+        return {"name": pathName, "ok": False, "cached": False, "timings": timings}
+
+    if bundle:
+        absPath = writeBundleLauncher(pathName, bundle, workDir)
+        options = bundleOptions(bundle)
+        bundled = localSources(os.path.join("./pkgs", tool) for tool in bundle)
+    else:
+        absPath = os.path.abspath(os.path.join("./pkgs",path))
+        options = pyinstallerOptions(excludedModules(absPath))
+        # Sibling modules the script imports are bundled by PyInstaller, so they are part of the build too
+        bundled = [source for source in localSources([absPath]) if source != absPath]
+    key = buildKey(absPath, env["requirements"], pythonVersion, options, bundled)
+    cached = loadBuildCache(pathName)
+    artifact = artifactPath(pathName)
+    archive = onedirArchivePath(pathName)
+    onefileCurrent = (not force and cached.get("key") == key and artifact is not None
+                      and fileSha256(artifact) == cached.get("sha256"))
+    onedirCurrent = not onedir or (not force and cached.get("onedir_key") == key and os.path.isfile(archive)
+                                   and fileSha256(archive) == cached.get("onedir_sha256"))
+    if onefileCurrent and onedirCurrent:
+        timings["total"] = time.monotonic() - started
+        return {"name": pathName, "ok": True, "cached": True, "timings": timings}
+
+    # Keep the previous release around so a delta to the new build can be published
+    previousPath = None
+    if artifact is not None and not onefileCurrent:
+        os.makedirs("./build/previous", exist_ok=True)
+        previousPath = os.path.join("./build/previous", pathName)
+        shutil.copy2(artifact, previousPath)
+
+    _, pythonPath = envTools(env["path"])
+    with open(os.path.join(workDir, "build.log"), "w", encoding="utf-8") as log, \
+            tempfile.TemporaryDirectory(delete=True) as specDir:
+        log.write(f"Build environment: {env['path']}\n")
+        log.write(f"Installed requirements: {' '.join(env['requirements'])}\n")
+        log.write(f"PyInstaller options: {' '.join(options)}\n")
+
+        # Separate work, spec and config dirs so parallel PyInstaller runs don't clash
+        toolEnv = dict(os.environ, PYINSTALLER_CONFIG_DIR=os.path.join(workDir, "pyinstaller-config"))
+        ok = True
+        if not onefileCurrent:
+            stepStart = time.monotonic()
+            ok = runLogged([pythonPath, "-m", "PyInstaller", absPath, *options,
+                            "--workpath", os.path.join(workDir, "work"), "--specpath", specDir,
+                            "--distpath", os.path.abspath("./dist")], log, toolEnv)
+            timings["pyinstaller"] = time.monotonic() - stepStart
+
+        if ok and not onedirCurrent:
+            stepStart = time.monotonic()
+            onedirDist = os.path.join(workDir, "onedir")
+            # Start from an empty dist dir: PyInstaller won't clear a non-empty one without a tty,
+            # and stale files would end up in the archive
+            shutil.rmtree(onedirDist, ignore_errors=True)
+            ok = runLogged([pythonPath, "-m", "PyInstaller", absPath, "--noconfirm",
+                            *["--onedir" if option == "--onefile" else option for option in options],
+                            "--workpath", os.path.join(workDir, "work-onedir"), "--specpath", specDir,
+                            "--distpath", onedirDist], log, toolEnv)
+            if ok:
+                packOnedir(pathName, onedirDist)
+            timings["onedir"] = time.monotonic() - stepStart
+
+    stepStart = time.monotonic()
+    if ok:
+        entry = dict(cached) if onefileCurrent else {"key": key, "sha256": fileSha256(artifactPath(pathName)),
+                                                     "requirements": env["requirements"]}
+        if not onefileCurrent:
+            publishDelta(pathName, previousPath)
+            publishCompressed(pathName)
+        if onedir:
+            entry.update({"onedir_key": key, "onedir_sha256": fileSha256(archive)})
+        elif cached.get("onedir_key") != key and os.path.exists(archive):
+            # An archive from an older build would no longer match the executable
+            os.remove(archive)
+            entry.pop("onedir_key", None)
+            entry.pop("onedir_sha256", None)
+        saveBuildCache(pathName, entry)
+    timings["publish"] = time.monotonic() - stepStart
+    timings["total"] = time.monotonic() - started
+    return {"name": pathName, "ok": ok, "cached": False, "timings": timings}
+
+def prepareEnvs(reqsByPath, pythonVersion, jobs, refresh=False):
+    """
+    Prepare the build environment of every package, one per distinct requirement set.
+
+    Environments are set up concurrently; the shared wheel cache is only
+    filled by one of them at a time. Returns the env for each path (None if
+    its environment failed) and the time spent preparing each environment.
+    """
+    groups = {}
+    for path, reqs in reqsByPath.items():
+        groups.setdefault(envKey(reqs, pythonVersion), reqs)
+
+    os.makedirs(ENVS_DIR, exist_ok=True)
+    downloadLock = threading.Lock()
+
+    def prepare(reqs):
+        stepStart = time.monotonic()
+        result = prepareEnv(reqs, pythonVersion, refresh, downloadLock)
+        return result, time.monotonic() - stepStart
+
+    with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(groups)))) as executor:
+        prepared = dict(zip(groups, executor.map(prepare, groups.values())))
+
+    reused = sum(1 for (_, _, wasReused), _ in prepared.values() if wasReused)
+    failed = [key for key, ((ok, _, _), _) in prepared.items() if not ok]
+    print(f"Build environments: {len(groups)} ({reused} reused, {len(groups) - reused - len(failed)} created"
+          + (f", {len(failed)} FAILED - see build/envs/<key>.log" if failed else "") + ")")
+
+    envs = {}
+    envTimes = {}
+    for path, reqs in reqsByPath.items():
+        (ok, env, _), elapsed = prepared[envKey(reqs, pythonVersion)]
+        envs[path] = env if ok else None
+        envTimes[path.split(".")[0]] = elapsed
+    return envs, envTimes
+
+def pythonVersion():
+    """Version of the python3 interpreter the build venvs are created from."""
+    result = subprocess.run(["python3", "-c", "import sys, platform; print(sys.version, platform.machine())"],
+                            capture_output=True, text=True)
+    return result.stdout.strip()
+
+def printTimings(results, wallTime):
+    steps = ["env", "pyinstaller", "onedir", "publish", "total"]
+    print()
+    print(f"{'package':<12}" + "".join(f"{step:>13}" for step in steps) + "  status")
+    for result in sorted(results, key=lambda r: r["name"]):
+        cells = "".join(f"{result['timings'].get(step, 0):>12.1f}s" for step in steps)
+        if result["cached"]:
+            status = "cached"
+        elif result["ok"]:
+            status = "ok"
+        else:
+            status = f"FAILED (see build/{result['name']}/build.log)"
+        print(f"{result['name']:<12}{cells}  {status}")
+    sequential = sum(r["timings"]["total"] for r in results)
+    print(f"Wall time {wallTime:.1f}s (sequential builds would be ~{sequential:.1f}s; env times are shared)")
+
+def timeRun(cmd, env):
+    started = time.perf_counter()
+    try:
+        subprocess.run(cmd, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       timeout=BENCH_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        return None
+    return time.perf_counter() - started
+
+def benchmarkPackage(pathName, runs):
+    """
+    Measure the size and the '--help' start time of one built executable.
+
+    A onefile executable unpacks itself into a temp dir on every run, so the
+    cold start is the first run with a fresh, empty TMPDIR right after the
+    build, and the warm start is the median of the following runs, when the
+    executable and its extracted files are in the OS cache.
+    """
+    artifact = os.path.abspath(artifactPath(pathName))
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, TMPDIR=tmp, TEMP=tmp, TMP=tmp)
+        cold = timeRun([artifact, "--help"], env)
+        warm = [timeRun([artifact, "--help"], env) for _ in range(runs)]
+    warm = [elapsed for elapsed in warm if elapsed is not None]
+    result = {
+        "sha256": fileSha256(artifact),
+        "size": os.path.getsize(artifact),
+        "cold": cold,
+        "warm": statistics.median(warm) if warm else None,
+        "measured_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+    }
+
+    # The onedir build is measured the way kpz installs it: unpacked once, then run in place
+    archive = onedirArchivePath(pathName)
+    if os.path.isfile(archive):
+        with tempfile.TemporaryDirectory() as tmp:
+            with tarfile.open(archive, "r:gz") as tar:
+                tar.extractall(tmp, filter="data")
+            executable = os.path.join(tmp, pathName, pathName + (".exe" if os.name == 'nt' else ""))
+            env = dict(os.environ, TMPDIR=tmp, TEMP=tmp, TMP=tmp)
+            onedirCold = timeRun([executable, "--help"], env)
+            onedirWarm = [timeRun([executable, "--help"], env) for _ in range(runs)]
+        onedirWarm = [elapsed for elapsed in onedirWarm if elapsed is not None]
+        result.update({
+            "onedir_sha256": fileSha256(archive),
+            "onedir_cold": onedirCold,
+            "onedir_warm": statistics.median(onedirWarm) if onedirWarm else None,
+        })
+    return result
+
+def benchRegressions(baseline, current, threshold):
+    """Describe every metric of current that is worse than baseline by more than threshold."""
+    regressions = []
+    for metric in ["size", "cold", "warm", "onedir_cold", "onedir_warm"]:
+        if metric not in baseline or metric not in current:
+            continue
+        old, new = baseline[metric], current[metric]
+        if old is None or new is None:
+            if old is not None:
+                regressions.append(f"{metric} timed out")
+            continue
+        if metric != "size" and new - old < BENCH_MIN_DELTA:
+            continue
+        if new > old * (1 + threshold):
+            shown = (lambda v: f"{v / 1024 / 1024:.1f} MB") if metric == "size" else (lambda v: f"{v:.2f}s")
+            regressions.append(f"{metric} {shown(old)} -> {shown(new)} (+{(new / old - 1) * 100:.0f}%)")
+    return regressions
+
+def runBenchmarks(names, threshold, runs, benchAll=False, accept=False):
+    """
+    Benchmark the built executables and compare them against the baseline in dist/bench.json.
+
+    Only executables that changed since they were last measured are run
+    (all of them with benchAll). A measurement becomes the new baseline unless
+    it regresses past threshold; accept makes the latest measurements the
+    baseline regardless.
+    Returns False if any package regressed.
+    """
+    try:
+        with open(BENCH_FILE, 'r', encoding="utf-8") as f:
+            bench = json.load(f)
+    except (OSError, ValueError):
+        bench = {}
+    baseline = {name: entry for name, entry in bench.get("baseline", {}).items() if name in names}
+    latest = {name: entry for name, entry in bench.get("latest", {}).items() if name in names}
+
+    ok = True
+    print()
+    print(f"{'package':<12}{'size':>10}{'cold':>9}{'warm':>9}{'dir cold':>10}{'dir warm':>10}  result")
+    for name in sorted(names):
+        artifact = artifactPath(name)
+        archive = onedirArchivePath(name)
+        onedirSha = fileSha256(archive) if os.path.isfile(archive) else None
+        measured = (benchAll or name not in latest or latest[name].get("sha256") != fileSha256(artifact)
+                    or latest[name].get("onedir_sha256") != onedirSha)
+        if measured:
+            latest[name] = benchmarkPackage(name, runs)
+        entry = latest[name]
+        # A regressed measurement stays pending (and keeps failing) until it is accepted
+        regressions = benchRegressions(baseline[name], entry, threshold) if name in baseline else []
+        if name not in baseline or accept:
+            result = "new baseline"
+            baseline[name] = entry
+        elif regressions:
+            ok = False
+            result = "REGRESSED: " + ", ".join(regressions)
+        else:
+            result = "ok" if measured else "unchanged"
+            baseline[name] = entry
+        times = []
+        for metric in ["cold", "warm", "onedir_cold", "onedir_warm"]:
+            if metric not in entry:
+                times.append("-")
+            else:
+                times.append(f"{entry[metric]:.2f}s" if entry[metric] is not None else "timeout")
+        print(f"{name:<12}{entry['size'] / 1024 / 1024:>8.1f}MB{times[0]:>9}{times[1]:>9}{times[2]:>10}{times[3]:>10}  {result}")
+
+    tmpPath = BENCH_FILE + ".tmp"
+    with open(tmpPath, 'w', encoding="utf-8") as f:
+        json.dump({"threshold": threshold, "baseline": baseline, "latest": latest}, f, indent=2, sort_keys=True)
+    os.replace(tmpPath, BENCH_FILE)
+    if not ok:
+        print(f"Benchmark regression past {threshold * 100:.0f}% - rerun with --accept-bench if it is expected")
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile the scripts in pkgs/ into standalone executables')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Number of packages to build in parallel (default: number of CPUs)')
+    parser.add_argument('--force', action='store_true', help='Rebuild packages even if their build inputs are unchanged')
+    parser.add_argument('--refresh-envs', action='store_true',
+                        help='Recreate the shared build environments (and fetch newer wheels if online)')
+    parser.add_argument('--bundle', action='store_true',
+                        help=f'Also build {BUNDLE_NAME}.exe, one multi-call executable containing every package')
+    parser.add_argument('--onedir', action='store_true',
+                        help='Also publish fast-start onedir builds that kpz unpacks once instead of on every run')
+    parser.add_argument('--no-bench', action='store_true', help='Skip the size and start time benchmark')
+    parser.add_argument('--bench-all', action='store_true', help='Benchmark every executable, not just changed ones')
+    parser.add_argument('--bench-runs', type=int, default=5, help='Warm start runs per executable (default: 5)')
+    parser.add_argument('--bench-threshold', type=float, default=0.2,
+                        help='Fail when size or start time grows by more than this fraction (default: 0.2)')
+    parser.add_argument('--accept-bench', action='store_true', help='Accept the new measurements as the baseline')
+    args = parser.parse_args()
+
+    paths = sorted(path for path in os.listdir("./pkgs") if path.endswith(".py"))
+    os.makedirs("./dist", exist_ok=True)
+
+    started = time.monotonic()
+    jobs = max(1, min(args.jobs, len(paths)))
+    version = pythonVersion()
+    reqsByPath = {path: packageRequirements(os.path.abspath(os.path.join("./pkgs", path))) for path in paths}
+    builds = [(path, None) for path in paths]
+    if args.bundle:
+        reqsByPath[BUNDLE_NAME + ".py"] = sorted(set().union(*reqsByPath.values()))
+        builds.append((BUNDLE_NAME + ".py", paths))
+    envs, envTimes = prepareEnvs(reqsByPath, version, jobs, args.refresh_envs)
+    print(f"Building {len(builds)} package(s) with {jobs} job(s)...")
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(buildPackage, [path for path, _ in builds], [envs[path] for path, _ in builds],
+                                    itertools.repeat(version), itertools.repeat(args.force),
+                                    [bundle for _, bundle in builds], itertools.repeat(args.onedir)))
+    for result in results:
+        result["timings"]["env"] = envTimes[result["name"]]
+    printTimings(results, time.monotonic() - started)
+
+    pkgs = [result["name"] + ".exe" for result in results if artifactPath(result["name"]) is not None]
+    registry = "\n".join(pkgs)
+    registryPath = "./dist/registry.txt"
+    previousRegistry = None
+    if os.path.exists(registryPath):
+        with open(registryPath, "r", encoding="utf-8") as f:
+            previousRegistry = f.read()
+    if registry != previousRegistry:
+        with open(registryPath, "w",encoding="utf-8") as f:
+            f.write(registry)
+
+    provides = {}
+    if args.bundle:
+        provides[BUNDLE_NAME + ".exe"] = [path.split(".")[0] + ".exe" for path in paths]
+    writeManifest(pkgs, provides=provides)
+
+    ok = all(result["ok"] for result in results)
+    if not args.no_bench:
+        built = [result["name"] for result in results if artifactPath(result["name"]) is not None]
+        ok = runBenchmarks(built, args.bench_threshold, max(1, args.bench_runs), args.bench_all, args.accept_bench) and ok
+    if not ok:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,46 @@
 import argparse
-import cv2
-import numpy as np
+import glob
+import hashlib
+import json
+import math
+import multiprocessing
 import os
+import queue
+import shutil
 import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Importing cv2 and numpy is most of the start-up time, so they are loaded by
+# load_imaging() only in processes that handle pixels, never in a client of img serve
+cv2 = None
+np = None
+
+SERVER_URL = os.environ.get("IMG_SERVER")  # img serve daemon that jobs are sent to, if any
+SERVE_HOST = "127.0.0.1"
+SERVE_PORT = 8765
+
+# Results are cached by input content, pipeline and output format; --no-cache skips it for one call
+CACHE_DIR = os.environ.get("IMG_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "img"))
+CACHE_MAX_SIZE = os.environ.get("IMG_CACHE_MAX_SIZE", "1G")  # Size cap of the result cache
+CACHE_VERSION = 1  # Bump when a change to the operations alters their output
+CACHE_FORMATS = {'.jpeg': '.jpg', '.jpe': '.jpg', '.tiff': '.tif'}
+CACHE_FLUSH_JOBS = 100  # Cached jobs img serve runs between saving the counters and evicting
+CHUNK_SIZE = 1024 * 1024
+
+def load_imaging():
+    """Import OpenCV and numpy into this module."""
+    global cv2, np
+    if cv2 is None:
+        import cv2
+        import numpy as np
 
 def resize_image(image, width=None, height=None, scale=None):
     """
@@ -109,16 +147,1451 @@ def apply_blur(image, kernel_size=5):
     """
     return cv2.GaussianBlur(image, (kernel_size, kernel_size), 0)
 
+OPERATIONS = ['resize', 'crop', 'rotate', 'flip', 'adjust', 'blur']
+IMAGE_EXTENSIONS = {'.bmp', '.jpg', '.jpeg', '.jpe', '.png', '.tif', '.tiff', '.webp', '.pbm', '.pgm', '.ppm', '.pnm'}
+
+# Video containers and the codec VideoWriter uses for each by default
+VIDEO_CODECS = {'.mp4': 'mp4v', '.m4v': 'mp4v', '.mov': 'mp4v', '.avi': 'MJPG', '.mkv': 'XVID', '.webm': 'VP80'}
+VIDEO_EXTENSIONS = set(VIDEO_CODECS) | {'.mpg', '.mpeg', '.wmv', '.flv', '.ts'}
+VIDEO_QUEUE_SIZE = 8  # Frames waiting between the decode, process and encode threads
+VIDEO_DEFAULT_FPS = 25.0  # For image sequence inputs, which carry no frame rate
+
+STAGE_FUNCTIONS = {
+    'resize': resize_image,
+    'crop': crop_image,
+    'rotate': rotate_image,
+    'flip': flip_image,
+    'adjust': adjust_brightness_contrast,
+    'blur': apply_blur,
+}
+
+# Parameters of each operation in a --pipeline spec: name -> (function argument, type)
+STAGE_PARAMS = {
+    'resize': {'width': ('width', int), 'height': ('height', int), 'scale': ('scale', float)},
+    'crop': {'x': ('x', int), 'y': ('y', int), 'width': ('width', int), 'height': ('height', int)},
+    'rotate': {'angle': ('angle', float)},
+    'flip': {'code': ('flip_code', int)},
+    'adjust': {'brightness': ('brightness', float), 'contrast': ('contrast', float)},
+    'blur': {'kernel': ('kernel_size', int)},
+}
+
+def check_stage(operation, params):
+    """
+    Check that a pipeline stage has the parameters its operation needs.
+
+    Returns:
+        An error message, or None if the stage is complete
+    """
+    if operation == 'resize' and all(params.get(name) is None for name in ('width', 'height', 'scale')):
+        return "resize needs at least one of: width, height, scale"
+    if operation == 'crop' and any(params.get(name) is None for name in ('x', 'y', 'width', 'height')):
+        return "crop needs all of: x, y, width, height"
+    if operation == 'rotate' and params.get('angle') is None:
+        return "rotate needs an angle"
+    if operation == 'flip' and params.get('flip_code') not in (0, 1, -1):
+        return "flip needs a code of 0 (vertical), 1 (horizontal) or -1 (both)"
+    return None
+
+def parse_pipeline(spec):
+    """
+    Parse a pipeline spec such as "resize:width=800,rotate:angle=90,blur:kernel=5".
+
+    Stages are separated by commas. A stage starts with the operation name,
+    optionally followed by ':' and its first key=value parameter; further
+    parameters of the same stage follow as comma-separated key=value items
+    ("crop:x=10,y=10,width=100,height=50").
+
+    Returns:
+        List of (operation, parameters) stages
+
+    Raises:
+        ValueError: If the spec is malformed
+    """
+    stages = []
+    for item in (item.strip() for item in spec.split(',')):
+        if not item:
+            continue
+        if ':' in item or '=' not in item:
+            operation, _, item = item.partition(':')
+            operation = operation.strip()
+            if operation not in STAGE_PARAMS:
+                raise ValueError(f"unknown operation '{operation}' (choose from {', '.join(OPERATIONS)})")
+            stages.append((operation, {}))
+            if not item.strip():
+                continue
+        if not stages:
+            raise ValueError(f"parameter '{item}' comes before any operation")
+        operation, params = stages[-1]
+        key, _, value = item.partition('=')
+        key = key.strip()
+        if key not in STAGE_PARAMS[operation]:
+            raise ValueError(f"{operation} has no parameter '{key}' (choose from {', '.join(STAGE_PARAMS[operation])})")
+        name, kind = STAGE_PARAMS[operation][key]
+        try:
+            params[name] = kind(value)
+        except ValueError:
+            raise ValueError(f"invalid value '{value}' for {operation} {key}")
+    if not stages:
+        raise ValueError("the pipeline is empty")
+    return stages
+
+def stages_from_args(args):
+    """
+    Build the pipeline to run from the command line: --pipeline, or --operation as a one-stage pipeline.
+
+    Raises:
+        ValueError: If the pipeline or the operation's parameters are invalid
+    """
+    if args.pipeline is not None:
+        stages = parse_pipeline(args.pipeline)
+    elif args.operation == 'resize':
+        stages = [('resize', {'width': args.width, 'height': args.height, 'scale': args.scale})]
+    elif args.operation == 'crop':
+        stages = [('crop', {'x': args.x, 'y': args.y, 'width': args.crop_width, 'height': args.crop_height})]
+    elif args.operation == 'rotate':
+        stages = [('rotate', {'angle': args.angle})]
+    elif args.operation == 'flip':
+        stages = [('flip', {'flip_code': args.flip_code})]
+    elif args.operation == 'adjust':
+        stages = [('adjust', {'brightness': args.brightness, 'contrast': args.contrast})]
+    elif args.operation == 'blur':
+        stages = [('blur', {'kernel_size': args.kernel_size})]
+    else:
+        raise ValueError("Unknown operation '{}'".format(args.operation))
+
+    for operation, params in stages:
+        error = check_stage(operation, params)
+        if error:
+            raise ValueError(error)
+    return stages
+
+GEOMETRIC_OPERATIONS = {'crop', 'flip', 'rotate', 'resize'}
+FUSE_MIN_SCALE = 1.0  # Downscales keep INTER_AREA, a bilinear warp would alias
+
+def plan_pipeline(stages, fuse=True):
+    """
+    Group the stages into steps; runs of geometric stages become one fused step.
+
+    Returns:
+        List of (label, stages) steps
+    """
+    plan = []
+    for index, (operation, params) in enumerate(stages, 1):
+        label = f"{index}.{operation}"
+        if fuse and operation in GEOMETRIC_OPERATIONS and plan and plan[-1][1][-1][0] in GEOMETRIC_OPERATIONS:
+            plan[-1] = (plan[-1][0] + "+" + label, plan[-1][1] + [(operation, params)])
+        else:
+            plan.append((label, [(operation, params)]))
+    return plan
+
+def stage_labels(stages, fuse=True):
+    """Names for the timings of decode, each pipeline step and encode."""
+    return ['decode'] + [label for label, _ in plan_pipeline(stages, fuse)] + ['encode']
+
+def resized_size(w, h, width=None, height=None, scale=None):
+    """Output size resize_image produces for an image of w x h."""
+    if scale is not None:
+        return int(round(w * scale)), int(round(h * scale))
+    if width is None and height is None:
+        return w, h
+    if width is None:
+        width = int(height * (w / h))
+    elif height is None:
+        height = int(width * (h / w))
+    return width, height
+
+def apply_affine(image, matrix, width, height, slicing, rotated=False):
+    """
+    Produce the width x height output of the affine matrix (output <- input, 3x3) with one pass over the image.
+
+    Crops and flips alone (slicing) are done with numpy slicing. Otherwise only
+    the region of the input the output can sample from is handed to warpAffine.
+    Without a rotation the image edge is replicated, as cv2.resize does; with
+    one the uncovered area is black, as in rotate_image.
+    """
+    if width <= 0 or height <= 0:
+        return image[:0, :0]
+    inverse = np.linalg.inv(matrix)
+    if slicing:
+        region, matrix = crop_window(image, matrix, width, height)
+        flipped_x, flipped_y = matrix[0, 0] < 0, matrix[1, 1] < 0
+        if flipped_x or flipped_y:
+            return cv2.flip(region, -1 if flipped_x and flipped_y else 1 if flipped_x else 0)
+        return region
+
+    # Crop first: bounding box of the input the output maps to, with a pixel of margin for interpolation
+    corners = np.array([[-0.5, -0.5, 1], [width - 0.5, -0.5, 1], [-0.5, height - 0.5, 1], [width - 0.5, height - 0.5, 1]])
+    source = corners @ inverse.T
+    h, w = image.shape[:2]
+    x0 = max(int(np.floor(source[:, 0].min())) - 1, 0)
+    y0 = max(int(np.floor(source[:, 1].min())) - 1, 0)
+    x1 = min(int(np.ceil(source[:, 0].max())) + 2, w)
+    y1 = min(int(np.ceil(source[:, 1].max())) + 2, h)
+    if x1 <= x0 or y1 <= y0:
+        return np.zeros((height, width) + image.shape[2:], dtype=image.dtype)
+    shift = np.array([[1, 0, x0], [0, 1, y0], [0, 0, 1]], dtype=np.float64)
+    return cv2.warpAffine(image[y0:y1, x0:x1], (matrix @ shift)[:2], (width, height), flags=cv2.INTER_LINEAR,
+                          borderMode=cv2.BORDER_CONSTANT if rotated else cv2.BORDER_REPLICATE)
+
+def crop_window(image, matrix, width, height):
+    """
+    Slice out the input window a crop/flip-only matrix maps to the width x height output.
+
+    Returns:
+        Tuple of the window (a view, no pixels are copied) and the matrix adjusted to it
+    """
+    # Axis-aligned unit scale with integer offsets: output pixel u comes from input a*u + b
+    inverse = np.linalg.inv(matrix)
+    ax, bx = int(round(inverse[0, 0])), int(round(inverse[0, 2]))
+    ay, by = int(round(inverse[1, 1])), int(round(inverse[1, 2]))
+    x0 = bx if ax == 1 else bx - width + 1
+    y0 = by if ay == 1 else by - height + 1
+    shift = np.array([[1, 0, x0], [0, 1, y0], [0, 0, 1]], dtype=np.float64)
+    return image[y0:y0 + height, x0:x0 + width], matrix @ shift
+
+def warp_stages(image, stages):
+    """
+    Run consecutive crop, flip, rotate and resize stages as one affine transform.
+
+    The stages are composed into a single matrix and the image is resampled
+    once, instead of once per stage with a full-size intermediate each time.
+    Crops and flips on their own are plain slicing, and crops before the first
+    rotate or resize slice the input down to the region of interest. A resize
+    that shrinks the image (below FUSE_MIN_SCALE) is still done with
+    resize_image (INTER_AREA), to avoid aliasing. A rotate after another
+    rotate resamples what came before first, so the corners the earlier one
+    clipped stay black, exactly as when the stages run one by one.
+
+    Args:
+        image: The input image
+        stages: List of geometric (operation, parameters) stages
+
+    Returns:
+        Processed image
+    """
+    h, w = image.shape[:2]
+    matrix = np.eye(3)
+    slicing = True
+    rotated = False  # The pending resample includes a rotation
+    windowed = False  # A crop came after a resample, so the next resample must not see past it
+    for operation, params in stages:
+        if operation in ('rotate', 'resize'):
+            if slicing:
+                # Crop first: only the region of interest is touched, and the rest stays out of reach
+                image, matrix = crop_window(image, matrix, w, h)
+            elif windowed or (operation == 'rotate' and rotated):
+                # The earlier crop or rotation clipped the frame; the next resample must not see past it
+                image = apply_affine(image, matrix, w, h, slicing, rotated)
+                matrix = np.eye(3)
+                slicing = True
+                rotated = False
+                windowed = False
+        if operation == 'crop':
+            x, y = max(params['x'], 0), max(params['y'], 0)
+            step = np.array([[1, 0, -x], [0, 1, -y], [0, 0, 1]], dtype=np.float64)
+            w, h = max(0, min(x + params['width'], w) - x), max(0, min(y + params['height'], h) - y)
+            windowed = not slicing
+        elif operation == 'flip':
+            sx = -1 if params['flip_code'] in (1, -1) else 1
+            sy = -1 if params['flip_code'] in (0, -1) else 1
+            step = np.array([[sx, 0, w - 1 if sx < 0 else 0], [0, sy, h - 1 if sy < 0 else 0], [0, 0, 1]],
+                            dtype=np.float64)
+        elif operation == 'rotate':
+            step = np.vstack([cv2.getRotationMatrix2D((w // 2, h // 2), params['angle'], 1.0), [0, 0, 1]])
+            slicing = False
+            rotated = True
+        else:
+            new_w, new_h = resized_size(w, h, **params)
+            if min(new_w / max(w, 1), new_h / max(h, 1)) < FUSE_MIN_SCALE:
+                image = apply_affine(image, matrix, w, h, slicing, rotated)
+                image = resize_image(image, **params)
+                h, w = image.shape[:2]
+                matrix = np.eye(3)
+                slicing = True
+                rotated = False
+                windowed = False
+                continue
+            sx, sy = new_w / w, new_h / h
+            # Pixel centres: x' + 0.5 = (x + 0.5) * s, as in cv2.resize
+            step = np.array([[sx, 0, 0.5 * sx - 0.5], [0, sy, 0.5 * sy - 0.5], [0, 0, 1]], dtype=np.float64)
+            w, h = new_w, new_h
+            slicing = slicing and sx == 1 and sy == 1
+        matrix = step @ matrix
+    if slicing and np.allclose(matrix, np.eye(3)) and (h, w) == image.shape[:2]:
+        return image
+    return apply_affine(image, matrix, w, h, slicing, rotated)
+
+def run_pipeline(image, stages, timings=None, fuse=True):
+    """
+    Run the stages on an in-memory image, one step after another.
+
+    Args:
+        image: The input image
+        stages: List of (operation, parameters) stages
+        timings: Optional list the time spent in each step (see stage_labels) is added to
+        fuse: Combine consecutive geometric stages into one resampling pass
+
+    Returns:
+        Processed image
+    """
+    for index, (_, step) in enumerate(plan_pipeline(stages, fuse)):
+        started = time.perf_counter()
+        if len(step) > 1:
+            image = warp_stages(image, step)
+        else:
+            operation, params = step[0]
+            image = STAGE_FUNCTIONS[operation](image, **params)
+        if timings is not None:
+            timings[index] += time.perf_counter() - started
+    return image
+
+def format_timings(labels, timings, count=1):
+    """Format per-stage times in milliseconds, averaged over count images."""
+    return ", ".join(f"{label} {timing / count * 1000:.1f} ms" for label, timing in zip(labels, timings))
+
+# JPEG start-of-frame markers, which carry the image size (not DHT, JPG and DAC)
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+REDUCED_DECODE_FLAGS = {2: 'IMREAD_REDUCED_COLOR_2', 4: 'IMREAD_REDUCED_COLOR_4', 8: 'IMREAD_REDUCED_COLOR_8'}
+
+def jpeg_size(path):
+    """
+    Read the image size from a JPEG's frame header without decoding it.
+
+    Returns:
+        Tuple of (width, height), or None if the file is not a JPEG
+    """
+    try:
+        with open(path, 'rb') as f:
+            if f.read(2) != b'\xff\xd8':
+                return None
+            while True:
+                byte = f.read(1)
+                if byte != b'\xff':
+                    return None
+                while byte == b'\xff':
+                    byte = f.read(1)
+                marker = byte[0] if byte else None
+                if marker is None or marker == 0xD9:
+                    return None
+                if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                    continue
+                length = int.from_bytes(f.read(2), 'big')
+                if marker in JPEG_SOF_MARKERS:
+                    header = f.read(5)
+                    if len(header) < 5:
+                        return None
+                    return int.from_bytes(header[3:5], 'big'), int.from_bytes(header[1:3], 'big')
+                f.seek(length - 2, os.SEEK_CUR)
+    except OSError:
+        return None
+
+def decode_image(path, stages, reduce=True):
+    """
+    Decode an image, at reduced resolution when the pipeline starts by shrinking it.
+
+    JPEGs can be decoded at 1/2, 1/4 or 1/8 size through DCT scaling, which
+    skips most of the decoding work and never holds the full-size pixels. The
+    largest reduction that still leaves at least the target size is used, and
+    the first resize stage is rewritten to the exact target so the result
+    keeps the requested size.
+
+    Args:
+        path: Input image path
+        stages: List of (operation, parameters) stages
+        reduce: Allow reduced decoding
+
+    Returns:
+        Tuple of (image or None, stages to run, reduction info or None). The info
+        has the reduction factor and the full and decoded size in bytes.
+    """
+    size = jpeg_size(path) if reduce and stages and stages[0][0] == 'resize' else None
+    if size is None:
+        return cv2.imread(path), stages, None
+
+    # The decoder applies the EXIF orientation, so allow for the image being turned
+    w, h = size
+    params = stages[0][1]
+    factor = 8
+    for full_w, full_h in ((w, h), (h, w)):
+        target_w, target_h = resized_size(full_w, full_h, **params)
+        if target_w <= 0 or target_h <= 0:
+            return cv2.imread(path), stages, None
+        limit = min(full_w / target_w, full_h / target_h)
+        factor = min(factor, max(f for f in (1, 2, 4, 8) if f <= max(limit, 1)))
+    if factor == 1:
+        return cv2.imread(path), stages, None
+
+    image = cv2.imread(path, getattr(cv2, REDUCED_DECODE_FLAGS[factor]))
+    if image is None:
+        return None, stages, None
+    rh, rw = image.shape[:2]
+    full_w, full_h = (w, h) if (rw, rh) == (-(-w // factor), -(-h // factor)) else (h, w)
+    target_w, target_h = resized_size(full_w, full_h, **params)
+    stages = [('resize', {'width': target_w, 'height': target_h})] + list(stages[1:])
+    channels = image.shape[2] if image.ndim == 3 else 1
+    info = {"factor": factor, "full_bytes": w * h * channels * image.itemsize, "decoded_bytes": image.nbytes}
+    return image, stages, info
+
+# Tiled mode works on uncompressed rasters it can memory-map: .npy arrays hold
+# BGR pixels like OpenCV, binary PNM files hold RGB
+TILED_OPERATIONS = {'crop', 'flip', 'adjust', 'blur'}
+TILED_EXTENSIONS = {'.npy', '.pgm', '.ppm', '.pnm'}
+TILE_WORKING_COPIES = 3  # The copied source region plus the input and output of the stage running on it
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+def parse_size(text):
+    """Parse a size such as "512M" or "2G" into bytes."""
+    value = text.strip().lower().removesuffix('b').removesuffix('i')
+    unit = value[-1:] if value[-1:] in SIZE_UNITS else ''
+    try:
+        size = int(float(value[:len(value) - len(unit)]) * SIZE_UNITS[unit])
+    except ValueError:
+        raise ValueError(f"invalid size '{text}'")
+    if size <= 0:
+        raise ValueError(f"invalid size '{text}'")
+    return size
+
+def read_pnm_header(f):
+    """
+    Read the header of a binary PGM/PPM file.
+
+    Returns:
+        Tuple of (channels, width, height, maxval, pixel data offset)
+    """
+    fields = []
+    magic = f.read(2)
+    if magic not in (b'P5', b'P6'):
+        raise ValueError("only binary PGM (P5) and PPM (P6) files can be memory-mapped")
+    byte = f.read(1)
+    while len(fields) < 3:
+        if byte == b'#':
+            while byte not in (b'\n', b'\r', b''):
+                byte = f.read(1)
+        elif byte.isspace():
+            byte = f.read(1)
+        elif byte.isdigit():
+            digits = b''
+            while byte.isdigit():
+                digits += byte
+                byte = f.read(1)
+            fields.append(int(digits))
+        else:
+            raise ValueError("malformed PNM header")
+    # A single whitespace byte separates the header from the pixels
+    if not byte.isspace():
+        raise ValueError("malformed PNM header")
+    width, height, maxval = fields
+    return (3 if magic == b'P6' else 1), width, height, maxval, f.tell()
+
+def open_raster(path):
+    """
+    Memory-map an uncompressed image for reading.
+
+    Returns:
+        Tuple of (read-only array of shape (height, width[, channels]), channel order 'bgr' or 'rgb')
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npy':
+        image = np.load(path, mmap_mode='r')
+        if image.dtype != np.uint8 or image.ndim not in (2, 3):
+            raise ValueError("a .npy image must be a uint8 array of shape (height, width[, channels])")
+        return image, 'bgr'
+    if ext not in TILED_EXTENSIONS:
+        raise ValueError(f"--max-memory reads {', '.join(sorted(TILED_EXTENSIONS))} images, not '{ext or path}'")
+    with open(path, 'rb') as f:
+        channels, width, height, maxval, offset = read_pnm_header(f)
+    if maxval > 255:
+        raise ValueError("16-bit PNM images are not supported with --max-memory")
+    shape = (height, width, 3) if channels == 3 else (height, width)
+    return np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=shape), 'rgb'
+
+def create_raster(path, shape):
+    """
+    Create an uncompressed image of the given shape and memory-map it for writing.
+
+    Returns:
+        Tuple of (writable array, channel order 'bgr' or 'rgb')
+    """
+    ext = os.path.splitext(path)[1].lower()
+    channels = shape[2] if len(shape) == 3 else 1
+    if ext == '.npy':
+        return np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=tuple(shape)), 'bgr'
+    if ext not in TILED_EXTENSIONS:
+        raise ValueError(f"--max-memory writes {', '.join(sorted(TILED_EXTENSIONS))} images, not '{ext or path}'")
+    if channels not in (1, 3) or (ext == '.ppm' and channels != 3) or (ext == '.pgm' and channels != 1):
+        raise ValueError(f"cannot write a {channels}-channel image as '{ext}'")
+    header = f"{'P6' if channels == 3 else 'P5'}\n{shape[1]} {shape[0]}\n255\n".encode()
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.truncate(len(header) + shape[0] * shape[1] * channels)
+    return np.memmap(path, dtype=np.uint8, mode='r+', offset=len(header), shape=tuple(shape)), 'rgb'
+
+def tile_frames(stages, width, height):
+    """
+    Image size before each stage and after the last one.
+
+    Raises:
+        ValueError: If a stage cannot run tile by tile
+    """
+    frames = [(width, height)]
+    for operation, params in stages:
+        if operation not in TILED_OPERATIONS:
+            raise ValueError(f"{operation} cannot run tile by tile; --max-memory supports {', '.join(sorted(TILED_OPERATIONS))}")
+        if operation == 'crop':
+            if params['x'] < 0 or params['y'] < 0:
+                raise ValueError("crop needs a non-negative x and y with --max-memory")
+            x0, y0 = min(params['x'], width), min(params['y'], height)
+            width, height = min(params['x'] + params['width'], width) - x0, min(params['y'] + params['height'], height) - y0
+            width, height = max(width, 0), max(height, 0)
+        elif operation == 'blur' and (params['kernel_size'] <= 0 or params['kernel_size'] % 2 == 0):
+            raise ValueError("blur needs a positive odd kernel size")
+        frames.append((width, height))
+    return frames
+
+def tile_halo(stages):
+    """Extra rows or columns of source a tile needs on each side for the local stages."""
+    return sum(params['kernel_size'] // 2 for operation, params in stages if operation == 'blur')
+
+def tile_regions(stages, frames, rect):
+    """
+    Walk an output rectangle back through the stages.
+
+    Args:
+        stages: List of (operation, parameters) stages
+        frames: Image sizes from tile_frames
+        rect: Output rectangle (x0, y0, x1, y1)
+
+    Returns:
+        The rectangle each stage reads, followed by the output rectangle
+    """
+    regions = [rect]
+    for (operation, params), (width, height) in zip(reversed(stages), reversed(frames[:-1])):
+        x0, y0, x1, y1 = rect
+        if operation == 'crop':
+            dx, dy = min(params['x'], width), min(params['y'], height)
+            rect = (x0 + dx, y0 + dy, x1 + dx, y1 + dy)
+        elif operation == 'flip':
+            if params['flip_code'] != 0:
+                x0, x1 = width - x1, width - x0
+            if params['flip_code'] != 1:
+                y0, y1 = height - y1, height - y0
+            rect = (x0, y0, x1, y1)
+        elif operation == 'blur':
+            # Pixels beyond the image edge are reflected by GaussianBlur, exactly as for the whole image
+            halo = params['kernel_size'] // 2
+            rect = (max(x0 - halo, 0), max(y0 - halo, 0), min(x1 + halo, width), min(y1 + halo, height))
+        regions.append(rect)
+    return regions[::-1]
+
+def run_tile(source, target, stages, regions, swap_channels):
+    """Read the source region of one tile, run the stages on it and store it in the target."""
+    x0, y0, x1, y1 = regions[0]
+    tile = np.array(source[y0:y1, x0:x1])
+    for (operation, params), rect, wanted in zip(stages, regions, regions[1:]):
+        if tile.size == 0:
+            break
+        if operation == 'blur':
+            # Keep only the pixels whose whole neighbourhood was in the tile
+            tile = apply_blur(tile, **params)
+            tile = tile[wanted[1] - rect[1]:wanted[3] - rect[1], wanted[0] - rect[0]:wanted[2] - rect[0]]
+        elif operation != 'crop':
+            tile = STAGE_FUNCTIONS[operation](tile, **params)
+    if swap_channels:
+        tile = tile[..., ::-1]
+    x0, y0, x1, y1 = regions[-1]
+    target[y0:y1, x0:x1] = tile
+
+def file_sha256(path):
+    """Compute the SHA-256 of a file without reading it into memory at once."""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def normalized_stages(stages):
+    """The stages with unset parameters dropped and whole floats as ints, so equal pipelines compare equal."""
+    def normalize(value):
+        return int(value) if isinstance(value, float) and value.is_integer() else value
+    return [[operation, {name: normalize(value) for name, value in sorted(params.items()) if value is not None}]
+            for operation, params in stages]
+
+def cache_format(output):
+    """Output format of a path, as the file extension the cached result is stored under."""
+    ext = os.path.splitext(output)[1].lower()
+    return CACHE_FORMATS.get(ext, ext)
+
+def cache_key(path, stages, reduce, output):
+    """
+    Key of a result in the cache.
+
+    It covers the input content, the normalized pipeline, whether reduced
+    decoding was allowed, the output format and the OpenCV version, which can
+    change decoded and encoded pixels.
+    """
+    spec = {
+        "version": CACHE_VERSION,
+        "opencv": cv2.__version__,
+        "input": file_sha256(path),
+        "stages": normalized_stages(stages),
+        "reduce": reduce,
+        "format": cache_format(output),
+    }
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+def cache_entry_path(cache_dir, key, output):
+    """Path of a cached result, addressed by its key."""
+    return os.path.join(cache_dir, "objects", key[:2], key + cache_format(output))
+
+def link_or_copy(source, target):
+    """Atomically make target a hard link to source, or a copy where links are not possible."""
+    tmp_path = os.path.join(os.path.dirname(target) or ".",
+                            f".{os.path.basename(target)}.{os.getpid()}.{threading.get_ident()}.part")
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copy2(source, tmp_path)
+    os.replace(tmp_path, target)
+
+def cache_fetch(cache_dir, key, output):
+    """Put a cached result at output and mark it as recently used. Returns whether it was cached."""
+    entry = cache_entry_path(cache_dir, key, output)
+    if not os.path.isfile(entry):
+        return False
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    link_or_copy(entry, output)
+    os.utime(entry)
+    return True
+
+def cache_store(cache_dir, key, output):
+    """Keep a freshly written result in the cache."""
+    entry = cache_entry_path(cache_dir, key, output)
+    if not os.path.isfile(entry):
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        link_or_copy(output, entry)
+
+def cache_evict(cache_dir, max_size):
+    """
+    Evict least recently used results until the cache fits max_size.
+
+    Returns:
+        Tuple of (number of evicted results, bytes freed)
+    """
+    entries = []
+    for root, _, files in os.walk(os.path.join(cache_dir, "objects")):
+        for name in files:
+            if not name.startswith("."):
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    evicted = 0
+    freed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        evicted += 1
+        freed += size
+    return evicted, freed
+
+def load_cache_stats(cache_dir):
+    """Load the hit and miss counters of the cache."""
+    stats = {"hits": 0, "misses": 0}
+    try:
+        with open(os.path.join(cache_dir, "stats.json"), 'r') as f:
+            stats.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+    return stats
+
+def cache_finish(cache_dir, hits, misses):
+    """
+    Add a run's hits and misses to the counters and evict down to the size cap.
+
+    Counters are best effort: concurrent runs can each overwrite the other's update.
+
+    Returns:
+        Tuple of (number of evicted results, bytes freed)
+    """
+    if not hits and not misses:
+        return 0, 0
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        stats = load_cache_stats(cache_dir)
+        stats["hits"] += hits
+        stats["misses"] += misses
+        fd, tmp_path = tempfile.mkstemp(prefix=".stats.json.", suffix=".part", dir=cache_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, os.path.join(cache_dir, "stats.json"))
+        return cache_evict(cache_dir, parse_size(CACHE_MAX_SIZE)) if misses else (0, 0)
+    except OSError as e:
+        print(f"Warning: could not update the result cache in '{cache_dir}': {e}")
+        return 0, 0
+
+def write_image(output, image):
+    """
+    Encode an image to output through a temporary file.
+
+    The output may be a hard link to a cached result, so it is replaced rather
+    than overwritten in place.
+
+    Returns:
+        Whether the image was written
+    """
+    stem, ext = os.path.splitext(output)
+    tmp_path = os.path.join(os.path.dirname(output) or ".",
+                            f".{os.path.basename(stem)}.{os.getpid()}.{threading.get_ident()}.part{ext}")
+    try:
+        if not cv2.imwrite(tmp_path, image):
+            return False
+        os.replace(tmp_path, output)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return True
+
+def expand_inputs(specs, recursive=False):
+    """
+    Expand input arguments into a list of image files.
+
+    Args:
+        specs: Files, directories, glob patterns, or '-' to read a list of paths from stdin
+        recursive: Also look into subdirectories of directories
+
+    Returns:
+        List of (path, base directory) tuples; the base is used to keep relative paths in the output
+    """
+    files = []
+    for spec in specs:
+        if spec == '-':
+            files.extend((line.strip(), None) for line in sys.stdin if line.strip())
+        elif os.path.isdir(spec):
+            for root, dirs, names in os.walk(spec):
+                dirs.sort()
+                for name in sorted(names):
+                    if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                        files.append((os.path.join(root, name), spec))
+                if not recursive:
+                    break
+        elif glob.has_magic(spec):
+            files.extend((path, None) for path in sorted(glob.glob(spec, recursive=True)) if os.path.isfile(path))
+        else:
+            files.append((spec, None))
+    return files
+
+def output_path(output_dir, template, path, base, index):
+    """
+    Build the output path of one batch item from the naming template.
+
+    The template can use {stem} (file name without extension), {ext} (extension
+    including the dot), {name} (full file name), {index} (position in the batch)
+    and {dir} (the item's subdirectory relative to an input directory).
+    """
+    name = os.path.basename(path)
+    stem, ext = os.path.splitext(name)
+    subdir = os.path.relpath(os.path.dirname(path), base) if base is not None else ""
+    subdir = "" if subdir == os.curdir else subdir
+    relative = template.format(stem=stem, ext=ext, name=name, index=index, dir=subdir)
+    if base is not None and "{dir}" not in template:
+        # Keep the layout of input directories
+        relative = os.path.join(subdir, relative)
+    return os.path.join(output_dir, relative)
+
+def init_worker():
+    load_imaging()
+    # One process per core already; OpenCV's own thread pool would oversubscribe the CPU
+    cv2.setNumThreads(1)
+
+def process_file(task):
+    """
+    Decode, transform and encode one image, or reuse its cached result.
+
+    Args:
+        task: Tuple of (input path, output path, pipeline stages, whether reduced decoding
+            is allowed, result cache directory or None)
+
+    Returns:
+        Tuple of (input path, error message or None, bytes read, bytes written, stage timings,
+        reduction info, cache hit: True, False or None without a cache)
+    """
+    path, output, stages, reduce, cache_dir = task
+    key = None
+    if cache_dir is not None:
+        # A broken cache only costs the time it saves
+        try:
+            key = cache_key(path, stages, reduce, output)
+            if cache_fetch(cache_dir, key, output):
+                return path, None, os.path.getsize(path), os.path.getsize(output), None, None, True
+        except OSError:
+            key = None
+
+    stage_timings = [0.0] * (len(stage_labels(stages)) - 2)
+    started = time.perf_counter()
+    image, stages, reduced = decode_image(path, stages, reduce)
+    decoded = time.perf_counter()
+    if image is None:
+        return path, "could not read image", 0, 0, None, None, None
+    try:
+        result = run_pipeline(image, stages, stage_timings)
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        encoding = time.perf_counter()
+        if not write_image(output, result):
+            return path, f"could not write '{output}'", os.path.getsize(path), 0, None, None, None
+        encoded = time.perf_counter()
+    except (cv2.error, ValueError, OSError) as e:
+        return path, str(e).strip(), os.path.getsize(path), 0, None, None, None
+    if key is not None:
+        try:
+            cache_store(cache_dir, key, output)
+        except OSError:
+            key = None
+    timings = [decoded - started] + stage_timings + [encoded - encoding]
+    return path, None, os.path.getsize(path), os.path.getsize(output), timings, reduced, (False if key else None)
+
+def format_reduced(reduced, seconds):
+    """Describe a reduced-resolution decode reported by decode_image."""
+    return (f"Decoded at 1/{reduced['factor']} size in {seconds * 1000:.1f} ms, holding "
+            f"{reduced['decoded_bytes'] / 1024 / 1024:.1f} MB of pixels instead of "
+            f"{reduced['full_bytes'] / 1024 / 1024:.1f} MB")
+
+def job_value(operation, name, kind, value):
+    """
+    Convert a stage parameter posted to img serve to its STAGE_PARAMS type.
+
+    Raises:
+        ValueError: If the value is not a finite number of that type
+    """
+    if value is None:
+        return None
+    try:
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            raise TypeError
+        converted = kind(value)
+        if not math.isfinite(converted) or (kind is int and isinstance(value, float) and not value.is_integer()):
+            raise ValueError
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid value {value!r} for {operation} {name}")
+    return converted
+
+def job_task(job, cache_dir=None, allowed_dirs=()):
+    """
+    Turn a job posted to img serve into a process_file task, using cache_dir unless the job opts out.
+
+    Args:
+        job: The decoded JSON body of the request
+        cache_dir: Result cache directory of the daemon, or None
+        allowed_dirs: Real paths of the directories the input and output must be inside
+
+    Raises:
+        ValueError: If the job is malformed, a stage is invalid or a path is outside allowed_dirs
+    """
+    if not isinstance(job, dict) or not isinstance(job.get("stages"), list):
+        raise ValueError("a job needs input, output and stages")
+    paths = job.get("input"), job.get("output")
+    if not all(isinstance(path, str) and os.path.isabs(path) for path in paths):
+        raise ValueError("input and output must be absolute paths")
+    for path in paths:
+        real = os.path.realpath(path)
+        if not any(os.path.commonpath([real, allowed]) == allowed for allowed in allowed_dirs):
+            raise ValueError(f"'{path}' is outside the directories this server may access")
+
+    stages = []
+    for stage in job["stages"]:
+        if not isinstance(stage, list) or len(stage) != 2 or stage[0] not in STAGE_FUNCTIONS:
+            raise ValueError(f"invalid stage {stage!r}")
+        operation, params = stage
+        kinds = dict(STAGE_PARAMS[operation].values())
+        if not isinstance(params, dict) or set(params) - set(kinds):
+            raise ValueError(f"invalid parameters for {operation}: {params!r}")
+        params = {name: job_value(operation, name, kinds[name], value) for name, value in params.items()}
+        error = check_stage(operation, params)
+        if error:
+            raise ValueError(error)
+        stages.append((operation, params))
+    return paths[0], paths[1], stages, not job.get("full_decode", False), cache_dir if job.get("cache", True) else None
+
+def run_job(task):
+    """Run a process_file task in a worker of img serve, timing it."""
+    started = time.perf_counter()
+    result = process_file(task)
+    return result, time.perf_counter() - started
+
+def send_job(server, task, replies=None):
+    """
+    Run a process_file task on an img serve daemon instead of in this process.
+
+    Args:
+        server: Base URL of the daemon
+        task: A process_file task; the daemon uses its own cache directory if the task has one
+        replies: Optional list the daemon's full reply is appended to
+
+    Returns:
+        The process_file result tuple
+    """
+    path, output, stages, reduce, cache_dir = task
+    body = json.dumps({"input": os.path.abspath(path), "output": os.path.abspath(output), "stages": stages,
+                       "full_decode": not reduce, "cache": cache_dir is not None}).encode()
+    request = urllib.request.Request(f"{server}/jobs", data=body, headers={"Content-Type": "application/json"})
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request) as response:
+            reply = json.load(response)
+    except urllib.error.HTTPError as e:
+        try:
+            reply = {"error": json.load(e)["error"]}
+        except (ValueError, KeyError, TypeError):
+            reply = {"error": f"server answered {e.code}"}
+    except (urllib.error.URLError, OSError, ValueError) as e:
+        reply = {"error": f"could not reach the img server at {server}: {getattr(e, 'reason', e)}"}
+    reply["round_trip"] = time.perf_counter() - started
+    if replies is not None:
+        replies.append(reply)
+    return (path, reply["error"], reply.get("bytes_read", 0), reply.get("bytes_written", 0),
+            reply.get("timings"), reply.get("reduced"), reply.get("cached"))
+
+def format_replies(replies):
+    """Summarize the latency and queueing the daemon reported for a set of jobs."""
+    answered = [reply for reply in replies if "latency" in reply]
+    if not answered:
+        return "no job reached the server"
+    latencies = sorted(reply["latency"] for reply in answered)
+    round_trip = sum(reply["round_trip"] for reply in answered) / len(answered)
+    return (f"latency mean {sum(latencies) / len(latencies) * 1000:.1f} ms, "
+            f"max {latencies[-1] * 1000:.1f} ms, round trip mean {round_trip * 1000:.1f} ms, "
+            f"up to {max(reply['queued'] for reply in answered)} job(s) queued ahead")
+
+def run_batch(args, stages):
+    """
+    Run the pipeline on every input into --output-dir, across a pool of worker processes.
+
+    With --server the jobs go to an img serve daemon instead, --jobs at a time.
+
+    Returns:
+        Number of failed items
+    """
+    files = expand_inputs(args.input, args.recursive)
+    if not files:
+        print("Error: No input images found")
+        return 1
+
+    tasks = []
+    outputs = {}
+    for index, (path, base) in enumerate(files):
+        output = output_path(args.output_dir, args.name_template, path, base, index)
+        if output in outputs:
+            print(f"Error: '{path}' and '{outputs[output]}' would both be written to '{output}'; "
+                  "use {index} or {dir} in --name-template")
+            return 1
+        if os.path.abspath(output) == os.path.abspath(path):
+            print(f"Error: '{path}' would be overwritten by its own output; use another --output-dir or --name-template")
+            return 1
+        outputs[output] = path
+        tasks.append((path, output, stages, not args.full_decode, None if args.no_cache else args.cache_dir))
+
+    jobs = max(1, min(args.jobs, len(tasks)))
+    print(f"Processing {len(tasks)} image(s) with {jobs} worker(s)...")
+    started = time.monotonic()
+    failed = 0
+    read = written = 0
+    labels = stage_labels(stages)
+    timings = [0.0] * len(labels)
+    reduced_count = 0
+    avoided = 0
+    hits = misses = 0
+    replies = []
+    if args.server is not None:
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        results = executor.map(lambda task: send_job(args.server, task, replies), tasks)
+    elif jobs == 1:
+        results = map(process_file, tasks)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker)
+        # Hand out work in chunks to keep the inter-process overhead per image low
+        results = executor.map(process_file, tasks, chunksize=max(1, len(tasks) // (jobs * 8)))
+    try:
+        for path, error, in_bytes, out_bytes, item_timings, reduced, cached in results:
+            read += in_bytes
+            written += out_bytes
+            hits += cached is True
+            misses += cached is False
+            if error is not None:
+                failed += 1
+                print(f"Error: {path}: {error}")
+            elif item_timings is not None:
+                timings = [total + timing for total, timing in zip(timings, item_timings)]
+            if reduced is not None:
+                reduced_count += 1
+                avoided += reduced["full_bytes"] - reduced["decoded_bytes"]
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    elapsed = max(time.monotonic() - started, 1e-9)
+    done = len(tasks) - failed
+    print(f"Processed {done} image(s), {failed} failed in {elapsed:.2f}s: {done / elapsed:.1f} images/s, "
+          f"{read / elapsed / 1024 / 1024:.1f} MB/s read, {written / elapsed / 1024 / 1024:.1f} MB/s written")
+    if done > hits:
+        print(f"Average per image: {format_timings(labels, timings, done - hits)}")
+    if hits or misses:
+        note = record_cache_run(args, hits, misses)
+        print(f"Cache: {hits} hit(s), {misses} miss(es)" + (f", {note}" if note else ""))
+    if reduced_count:
+        print(f"Reduced decoding: {reduced_count} image(s), {avoided / 1024 / 1024:.1f} MB of decoded pixels avoided")
+    if args.server is not None:
+        print(f"Server: {format_replies(replies)}")
+    return failed
+
+def run_tiled(args, stages):
+    """
+    Run the pipeline in horizontal strips between memory-mapped images, within --max-memory.
+
+    Only the strips in flight are held in memory, so the peak does not grow with
+    the image size. Strips are processed by a pool of --jobs threads.
+    """
+    budget = parse_size(args.max_memory)
+    source, source_order = open_raster(args.input)
+    height, width = source.shape[:2]
+    channels = source.shape[2] if source.ndim == 3 else 1
+    frames = tile_frames(stages, width, height)
+    out_width, out_height = frames[-1]
+    if out_width == 0 or out_height == 0:
+        raise ValueError("the pipeline produces an empty image")
+
+    # Size the strips so every thread's working copies of its strip fit the budget
+    jobs = max(1, args.jobs)
+    halo = tile_halo(stages)
+    row_bytes = width * channels * TILE_WORKING_COPIES
+    rows = budget // jobs // row_bytes - 2 * halo
+    if rows < 1:
+        raise ValueError(f"--max-memory must be at least {(2 * halo + 1) * row_bytes * jobs / 1024 / 1024:.1f} MB "
+                         f"for this image with {jobs} job(s)")
+    rows = min(rows, out_height)
+    jobs = min(jobs, -(-out_height // rows))
+
+    strips = [tile_regions(stages, frames, (0, y, out_width, min(y + rows, out_height)))
+              for y in range(0, out_height, rows)]
+    print(f"Processing {width}x{height} image in {len(strips)} strip(s) of {rows} row(s) with {jobs} thread(s), "
+          f"at most {(rows + 2 * halo) * row_bytes * jobs / 1024 / 1024:.1f} MB of working memory")
+
+    # Build the output next to its destination and move it into place once complete, so a failed
+    # run leaves no half-written raster and the output may be the memory-mapped input itself
+    stem, ext = os.path.splitext(args.output)
+    tmp_path = os.path.join(os.path.dirname(args.output) or ".", f".{os.path.basename(stem)}.{os.getpid()}.part{ext}")
+    try:
+        target, target_order = create_raster(tmp_path, (out_height, out_width) + source.shape[2:])
+        swap_channels = channels == 3 and source_order != target_order
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            # Submit a window of strips at a time so finished output pages get written back as we go
+            for first in range(0, len(strips), jobs):
+                for future in [executor.submit(run_tile, source, target, stages, regions, swap_channels)
+                               for regions in strips[first:first + jobs]]:
+                    future.result()
+                target.flush()
+        elapsed = max(time.perf_counter() - started, 1e-9)
+        # Unmap both files first: Windows cannot replace a file that is still mapped
+        del target, source
+        os.replace(tmp_path, args.output)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    print(f"Image successfully processed and saved to '{args.output}'")
+    print(f"Processed {width * height / 1e6:.1f} MP in {elapsed:.2f}s: {width * height / 1e6 / elapsed:.1f} MP/s")
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """Run jobs posted by img clients on a pool of worker processes.
+
+    POST /jobs takes {"input", "output", "stages", "full_decode"} with absolute
+    paths on this machine and answers once the job ran, with its result, the
+    latency and how many jobs were queued ahead of it. GET /status reports the
+    load of the pool.
+    Any local process can post jobs, which read and write files as the user
+    running the daemon, so paths outside allowed_dirs are refused.
+    """
+    executor = None
+    workers = 1
+    cache_dir = None
+    allowed_dirs = ()
+    stats = {}
+    _lock = threading.Lock()
+
+    def do_GET(self):
+        if urllib.parse.urlsplit(self.path).path != "/status":
+            self.send_error(404)
+            return
+        with self._lock:
+            stats = dict(self.stats)
+        completed = stats["completed"] + stats["failed"]
+        self.send_json(200, {
+            "workers": self.workers,
+            "in_flight": stats["in_flight"],
+            "queued": max(0, stats["in_flight"] - self.workers),
+            "completed": stats["completed"],
+            "failed": stats["failed"],
+            "cache_hits": stats["hits"],
+            "cache_misses": stats["misses"],
+            "mean_latency": stats["latency"] / completed if completed else None,
+            "uptime": time.monotonic() - stats["started"],
+        })
+
+    def do_POST(self):
+        if urllib.parse.urlsplit(self.path).path != "/jobs":
+            self.send_error(404)
+            return
+        received = time.perf_counter()
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            task = job_task(json.loads(self.rfile.read(length)), self.cache_dir, self.allowed_dirs)
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+
+        with self._lock:
+            queued = max(0, self.stats["in_flight"] - self.workers)
+            self.stats["in_flight"] += 1
+        try:
+            result, processing = self.executor.submit(run_job, task).result()
+        except BrokenProcessPool:
+            self.send_json(500, {"error": "the worker pool stopped"})
+            return
+        except Exception as e:
+            print(f"{task[0]}: job failed: {e!r}")
+            self.send_json(500, {"error": f"job failed: {e}"})
+            return
+        finally:
+            with self._lock:
+                self.stats["in_flight"] -= 1
+        latency = time.perf_counter() - received
+
+        path, error, bytes_read, bytes_written, timings, reduced, cached = result
+        with self._lock:
+            self.stats["failed" if error else "completed"] += 1
+            self.stats["latency"] += latency
+            self.stats["hits"] += cached is True
+            self.stats["misses"] += cached is False
+            self.record_cache(cached is True, cached is False)
+        print(f"{path}: {error or ('cached' if cached else 'done')} in {latency * 1000:.1f} ms "
+              f"({(latency - processing) * 1000:.1f} ms waiting, {queued} job(s) queued ahead)")
+        self.send_json(200, {"error": error, "bytes_read": bytes_read, "bytes_written": bytes_written,
+                             "timings": timings, "reduced": reduced, "cached": cached, "latency": latency,
+                             "processing": processing, "queued": queued})
+
+    def record_cache(self, hits, misses):
+        """Count hits and misses, saving the counters and evicting every CACHE_FLUSH_JOBS cached jobs."""
+        self.stats["pending_hits"] += hits
+        self.stats["pending_misses"] += misses
+        if self.stats["pending_hits"] + self.stats["pending_misses"] >= CACHE_FLUSH_JOBS:
+            self.flush_cache()
+
+    @classmethod
+    def flush_cache(cls):
+        if cls.cache_dir is not None:
+            cache_finish(cls.cache_dir, cls.stats["pending_hits"], cls.stats["pending_misses"])
+        cls.stats["pending_hits"] = cls.stats["pending_misses"] = 0
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Jobs are reported with their latency instead of the default access log
+        pass
+
+class JobServer(ThreadingHTTPServer):
+    # Room for a burst of clients waiting to connect while the pool is busy
+    request_queue_size = 128
+
+def serve(argv):
+    """Run img serve, a local daemon that keeps cv2 loaded in a pool of workers."""
+    parser = argparse.ArgumentParser(prog='img serve',
+                                     description='Keep a pool of image workers running for img --server clients')
+    parser.add_argument('--host', default=SERVE_HOST, help=f'Address to listen on (default: {SERVE_HOST})')
+    parser.add_argument('--port', type=int, default=SERVE_PORT, help=f'Port to listen on (default: {SERVE_PORT})')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help=f'Result cache directory (default: {CACHE_DIR})')
+    parser.add_argument('--no-cache', action='store_true', help='Do not cache results for any client')
+    parser.add_argument('--allow-dir', action='append',
+                        help='Directory clients may read and write images in; repeat for several. Jobs run as the '
+                             'user of the daemon, so keep this narrow (default: the current directory)')
+    parser.add_argument('--status', action='store_true', help='Show the load of a running daemon and exit')
+    args = parser.parse_args(argv)
+
+    if args.status:
+        try:
+            with urllib.request.urlopen(f"http://{args.host}:{args.port}/status") as response:
+                status = json.load(response)
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            print(f"Error: could not reach the img server on {args.host}:{args.port}: {getattr(e, 'reason', e)}")
+            return 1
+        mean = f"{status['mean_latency'] * 1000:.1f} ms" if status['mean_latency'] is not None else "n/a"
+        print(f"{status['workers']} worker(s), {status['in_flight']} job(s) in flight, {status['queued']} queued; "
+              f"{status['completed']} done, {status['failed']} failed, mean latency {mean}, "
+              f"cache {status['cache_hits']} hit(s), {status['cache_misses']} miss(es), up {status['uptime']:.0f}s")
+        return 0
+
+    load_imaging()
+    jobs = max(1, args.jobs)
+    executor = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker)
+    # Start every worker now so that no request waits for the imports
+    for future in [executor.submit(time.sleep, 0.1) for _ in range(jobs)]:
+        future.result()
+    JobRequestHandler.executor = executor
+    JobRequestHandler.workers = jobs
+    JobRequestHandler.cache_dir = None if args.no_cache else os.path.abspath(args.cache_dir)
+    JobRequestHandler.allowed_dirs = tuple(os.path.realpath(path) for path in args.allow_dir or [os.getcwd()])
+    JobRequestHandler.stats = {"in_flight": 0, "completed": 0, "failed": 0, "latency": 0.0, "hits": 0, "misses": 0,
+                               "pending_hits": 0, "pending_misses": 0, "started": time.monotonic()}
+    try:
+        server = JobServer((args.host, args.port), JobRequestHandler)
+    except OSError as e:
+        print(f"Error: could not listen on {args.host}:{args.port}: {e}")
+        executor.shutdown()
+        return 1
+    print(f"Serving img jobs on http://{args.host}:{args.port} with {jobs} worker(s), "
+          f"for files in {', '.join(JobRequestHandler.allowed_dirs)}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        executor.shutdown()
+        JobRequestHandler.flush_cache()
+    return 0
+
+def record_cache_run(args, hits, misses):
+    """Record a local run in the result cache. Returns a note on what eviction freed, or None."""
+    if args.server is not None or args.no_cache:
+        return None
+    evicted, freed = cache_finish(args.cache_dir, hits, misses)
+    return f"evicted {evicted} old result(s), {freed / 1024 / 1024:.1f} MB" if evicted else None
+
+def cache_command(argv):
+    """Run img cache: show or clear the result cache."""
+    parser = argparse.ArgumentParser(prog='img cache', description='Show or clear the img result cache')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help=f'Result cache directory (default: {CACHE_DIR})')
+    parser.add_argument('--clear', action='store_true', help='Remove every cached result and reset the counters')
+    args = parser.parse_args(argv)
+
+    if args.clear:
+        shutil.rmtree(args.cache_dir, ignore_errors=True)
+        print(f"Cleared the result cache in '{args.cache_dir}'")
+        return 0
+
+    count = size = 0
+    for root, _, files in os.walk(os.path.join(args.cache_dir, "objects")):
+        for name in files:
+            if not name.startswith("."):
+                count += 1
+                size += os.path.getsize(os.path.join(root, name))
+    stats = load_cache_stats(args.cache_dir)
+    lookups = stats["hits"] + stats["misses"]
+    rate = f"{stats['hits'] / lookups * 100:.0f}%" if lookups else "n/a"
+    print(f"Cache directory: {args.cache_dir}")
+    print(f"Results: {count}, {size / 1024 / 1024:.1f} MB of {parse_size(CACHE_MAX_SIZE) / 1024 / 1024:.1f} MB limit")
+    print(f"Hits: {stats['hits']}, misses: {stats['misses']} (hit rate {rate})")
+    return 0
+
+def is_sequence(path):
+    """Whether a path is a numbered image sequence such as frame_%05d.png."""
+    return '%' in os.path.basename(path)
+
+def is_video(path):
+    """Whether a path is a video file or a numbered image sequence."""
+    return is_sequence(path) or os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS
+
+def put_frame(frames, item, stop):
+    """Put an item on a bounded queue, giving up once stop is set. Returns whether it was queued."""
+    while not stop.is_set():
+        try:
+            frames.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def get_frame(frames, stop):
+    """Take an item from a queue, or None once stop is set."""
+    while not stop.is_set():
+        try:
+            return frames.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+def run_video(args, stages):
+    """
+    Run the pipeline on every frame of a video or image sequence.
+
+    Frames are decoded, processed and encoded on three threads connected by
+    bounded queues, so memory use stays the same whatever the length of the
+    video. The result is written with VideoWriter, or as a numbered sequence
+    when --output has a %d pattern.
+
+    Raises:
+        ValueError: If the input cannot be read or the output cannot be written
+    """
+    if not is_video(args.output):
+        raise ValueError(f"write video frames to a video file ({', '.join(sorted(VIDEO_CODECS))}) "
+                         "or a numbered sequence such as frame_%05d.png")
+    extension = os.path.splitext(args.output)[1].lower()
+    if not is_sequence(args.output) and not args.fourcc and extension not in VIDEO_CODECS:
+        raise ValueError(f"cannot write '{args.output}'; give a --fourcc codec or use one of "
+                         f"{', '.join(sorted(VIDEO_CODECS))}")
+    capture = cv2.VideoCapture(args.input)
+    if not capture.isOpened():
+        raise ValueError(f"could not open '{args.input}' as a video or image sequence")
+    fps = args.fps or (None if is_sequence(args.input) else capture.get(cv2.CAP_PROP_FPS)) or VIDEO_DEFAULT_FPS
+    total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    labels = stage_labels(stages)
+    timings = [0.0] * len(labels)
+    stage_timings = [0.0] * (len(labels) - 2)
+    decoded = queue.Queue(maxsize=args.queue_size)
+    processed = queue.Queue(maxsize=args.queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def read():
+        try:
+            while True:
+                started = time.perf_counter()
+                ok, frame = capture.read()
+                timings[0] += time.perf_counter() - started
+                if not ok or not put_frame(decoded, frame, stop):
+                    break
+        except Exception as e:
+            # Stored and re-raised on the main thread, so the run fails instead of ending early
+            errors.append(e)
+            stop.set()
+        finally:
+            put_frame(decoded, None, stop)
+
+    def process():
+        try:
+            while True:
+                frame = get_frame(decoded, stop)
+                if frame is None or not put_frame(processed, run_pipeline(frame, stages, stage_timings), stop):
+                    break
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            put_frame(processed, None, stop)
+
+    # The output path is fixed, so an existing file is overwritten
+    print(f"Processing {args.input} ({total or 'unknown number of'} frame(s) at {fps:g} fps)...")
+    threads = [threading.Thread(target=read, daemon=True), threading.Thread(target=process, daemon=True)]
+    for thread in threads:
+        thread.start()
+    writer = None
+    count = 0
+    started = time.perf_counter()
+    try:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        while True:
+            frame = get_frame(processed, stop)
+            if frame is None:
+                break
+            if frame.size == 0:
+                raise ValueError("the pipeline produces an empty frame")
+            encoding = time.perf_counter()
+            if is_sequence(args.output):
+                path = args.output % count
+                if not cv2.imwrite(path, frame):
+                    raise ValueError(f"could not write '{path}'")
+            else:
+                if writer is None:
+                    fourcc = cv2.VideoWriter_fourcc(*(args.fourcc or VIDEO_CODECS[extension]))
+                    size = (frame.shape[1], frame.shape[0])
+                    writer = cv2.VideoWriter(args.output, fourcc, fps, size, frame.ndim == 3)
+                    if not writer.isOpened():
+                        raise ValueError(f"could not open '{args.output}' for writing with this codec")
+                writer.write(frame)
+            timings[-1] += time.perf_counter() - encoding
+            count += 1
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        capture.release()
+        if writer is not None:
+            writer.release()
+    if errors:
+        raise errors[0]
+    if count == 0:
+        raise ValueError(f"'{args.input}' has no frames")
+
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    timings[1:-1] = stage_timings
+    print(f"Video successfully processed and saved to '{args.output}'")
+    print(f"Processed {count} frame(s) in {elapsed:.2f}s: {count / elapsed:.1f} frames/s")
+    print(f"Average per frame: {format_timings(labels, timings, count)}")
+
 def main():
+    if sys.argv[1:2] == ['serve']:
+        sys.exit(serve(sys.argv[2:]))
+    if sys.argv[1:2] == ['cache']:
+        sys.exit(cache_command(sys.argv[2:]))
+
     parser = argparse.ArgumentParser(description='Image manipulation utility')
 
     # Input and output arguments
-    parser.add_argument('-i', '--input', required=True, help='Input image path')
-    parser.add_argument('-o', '--output', required=True, help='Output image path')
+    parser.add_argument('-i', '--input', required=True, nargs='+',
+                        help='Input image path, video or numbered image sequence (frame_%%05d.png); '
+                             'with --output-dir also directories, globs or - for a list on stdin')
+    parser.add_argument('-o', '--output', help='Output image path, or video or numbered sequence for a video input')
+
+    # Batch arguments
+    parser.add_argument('--output-dir', help='Process every input and write the results to this directory')
+    parser.add_argument('--name-template', default='{stem}{ext}',
+                        help='Output file name in batch mode, from {stem}, {ext}, {name}, {index} and {dir} '
+                             '(default: {stem}{ext})')
+    parser.add_argument('-r', '--recursive', action='store_true', help='Include subdirectories of input directories')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Number of worker processes in batch mode (default: number of CPUs)')
+    parser.add_argument('--full-decode', action='store_true',
+                        help='Always decode at full resolution, even when the pipeline starts by shrinking the image')
+    parser.add_argument('--server', default=SERVER_URL,
+                        help='Run the job on an "img serve" daemon at this URL, e.g. http://127.0.0.1:8765 '
+                             '(default: $IMG_SERVER)')
+    parser.add_argument('--cache-dir', default=CACHE_DIR,
+                        help=f'Result cache directory (default: $IMG_CACHE_DIR or {CACHE_DIR})')
+    parser.add_argument('--no-cache', action='store_true', help='Neither reuse nor store a cached result')
+    parser.add_argument('--fps', type=float,
+                        help=f'Frame rate of a video output (default: the input\'s, or {VIDEO_DEFAULT_FPS:g} for '
+                             'image sequences)')
+    parser.add_argument('--fourcc', help='Codec of a video output, e.g. mp4v, MJPG, XVID (default: by extension)')
+    parser.add_argument('--queue-size', type=int, default=VIDEO_QUEUE_SIZE,
+                        help=f'Frames buffered between the decode, process and encode threads (default: {VIDEO_QUEUE_SIZE})')
+    parser.add_argument('--max-memory',
+                        help='Process the image in strips between memory-mapped .npy/.ppm/.pgm files, using at most '
+                             'this much working memory (e.g. 512M); supports crop, flip, adjust and blur')
 
     # Operation selection
-    parser.add_argument('--operation', choices=['resize', 'crop', 'rotate', 'flip', 'adjust', 'blur'], 
-                        required=True, help='Operation to perform')
+    operation = parser.add_mutually_exclusive_group(required=True)
+    operation.add_argument('--operation', choices=OPERATIONS, help='Operation to perform')
+    operation.add_argument('--pipeline',
+                           help='Operations to run in order on the decoded image, '
+                                'e.g. "resize:width=800,rotate:angle=90,blur:kernel=5"')
 
     # Resize parameters
     parser.add_argument('--width', type=int, help='Target width for resize')
@@ -147,53 +1620,82 @@ def main():
 
     args = parser.parse_args()
 
-    # Check if input file exists
-    if not os.path.isfile(args.input):
-        print(f"Error: Input file '{args.input}' does not exist")
-        sys.exit(1)
-
-    # Read the input image
-    image = cv2.imread(args.input)
-    if image is None:
-        print(f"Error: Could not read image '{args.input}'")
+    try:
+        stages = stages_from_args(args)
+    except ValueError as e:
+        print(f"Error: {e}")
         sys.exit(1)
 
-    # Perform the selected operation
-    if args.operation == 'resize':
-        if args.width is None and args.height is None and args.scale is None:
-            print("Error: For resize operation, provide at least one of: --width, --height, --scale")
+    if args.server is not None:
+        args.server = args.server.rstrip("/")
+        if args.max_memory is not None:
+            print("Error: --max-memory runs locally and cannot be combined with --server")
             sys.exit(1)
-        result = resize_image(image, args.width, args.height, args.scale)
+    else:
+        load_imaging()
 
-    elif args.operation == 'crop':
-        if args.x is None or args.y is None or args.crop_width is None or args.crop_height is None:
-            print("Error: For crop operation, provide all of: --x, --y, --crop-width, --crop-height")
+    if args.output_dir is not None:
+        if args.max_memory is not None:
+            print("Error: --max-memory processes a single image")
             sys.exit(1)
-        result = crop_image(image, args.x, args.y, args.crop_width, args.crop_height)
+        sys.exit(1 if run_batch(args, stages) else 0)
 
-    elif args.operation == 'rotate':
-        if args.angle is None:
-            print("Error: For rotate operation, provide --angle")
-            sys.exit(1)
-        result = rotate_image(image, args.angle)
+    if args.output is None or len(args.input) != 1:
+        print("Error: Provide a single --input and an --output, or use --output-dir to process several images")
+        sys.exit(1)
+    args.input = args.input[0]
 
-    elif args.operation == 'flip':
-        if args.flip_code is None:
-            print("Error: For flip operation, provide --flip-code")
+    # Videos and image sequences (frame_%05d.png) are streamed frame by frame
+    if is_video(args.input):
+        if args.server is not None or args.max_memory is not None:
+            print("Error: videos are processed locally and cannot be combined with --server or --max-memory")
+            sys.exit(1)
+        try:
+            run_video(args, stages)
+        except (ValueError, OSError, cv2.error) as e:
+            print(f"Error: {str(e).strip()}")
             sys.exit(1)
-        result = flip_image(image, args.flip_code)
+        return
 
-    elif args.operation == 'adjust':
-        result = adjust_brightness_contrast(image, args.brightness, args.contrast)
+    # Check if input file exists
+    if not os.path.isfile(args.input):
+        print(f"Error: Input file '{args.input}' does not exist")
+        sys.exit(1)
 
-    elif args.operation == 'blur':
-        result = apply_blur(image, args.kernel_size)
-    else:
-        raise ValueError("Unknown operation '{}'".format(args.operation))
+    if args.max_memory is not None:
+        try:
+            run_tiled(args, stages)
+        except (ValueError, OSError, cv2.error) as e:
+            print(f"Error: {str(e).strip()}")
+            sys.exit(1)
+        return
 
-    # Save the result
-    cv2.imwrite(args.output, result)
+    # Run the one image like a batch of one, through the daemon with --server
+    task = (args.input, args.output, stages, not args.full_decode, None if args.no_cache else args.cache_dir)
+    replies = []
+    if args.server is not None:
+        result = send_job(args.server, task, replies)
+    else:
+        result = process_file(task)
+    _, error, _, _, timings, reduced, cached = result
+    if error is not None:
+        print(f"Error: {args.input}: {error}")
+        sys.exit(1)
+    if cached:
+        print("Reused the cached result")
+    if reduced is not None:
+        print(format_reduced(reduced, timings[0]))
     print(f"Image successfully processed and saved to '{args.output}'")
+    if timings is not None:
+        print(f"Timings: {format_timings(stage_labels(stages), timings)}")
+    if args.server is not None:
+        print(f"Server: {format_replies(replies)}")
+    else:
+        note = record_cache_run(args, cached is True, cached is False)
+        if note:
+            print(f"Cache: {note}")
 
 if __name__ == "__main__":
+    # Worker processes of frozen (PyInstaller) builds start through here on Windows
+    multiprocessing.freeze_support()
     main()
@@ -1,14 +1,62 @@
 import argparse
+import contextlib
+import email.utils
+import gzip
+import hashlib
+import json
 import os
+import struct
+import tarfile
+import zlib
 import sys
 import requests
 import subprocess
 import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.adapters import HTTPAdapter
+
+if os.name == 'nt':  # Windows
+    import msvcrt
+else:  # Linux/Unix
+    import fcntl
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Failures of a compressed download that the uncompressed one may not hit. Compressed bodies
+# are read through urllib3 directly, whose errors requests does not wrap
+COMPRESSED_DOWNLOAD_ERRORS = (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, OSError,
+                              zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
 
 # Constants
-SERVER_URL = "http://localhost:8080"
+SERVER_URL = os.environ.get("KPZ_SERVER_URL", "http://localhost:8080").rstrip("/")
 BIN_DIR = os.path.abspath("./bin")
 REGISTRY_FILE = os.path.join(BIN_DIR, "registry.txt")
+HTTP_CACHE_FILE = os.path.join(BIN_DIR, "http-cache.json")
+INSTALLED_FILE = os.path.join(BIN_DIR, "installed.json")
+LOCK_FILE = os.path.join(BIN_DIR, ".kpz.lock")
+MANIFEST_FILE = os.path.join(BIN_DIR, "manifest.json")
+MANIFEST_TTL = int(os.environ.get("KPZ_MANIFEST_TTL", "300"))  # Seconds before the cached manifest is revalidated
+CACHE_DIR = os.path.join(os.path.dirname(BIN_DIR), "cache")
+CACHE_INDEX_FILE = os.path.join(CACHE_DIR, "index.json")
+CACHE_MAX_SIZE = os.environ.get("KPZ_CACHE_MAX_SIZE", "2G")  # Size cap of the package cache
+MIRROR_DIR = os.path.join(os.path.dirname(BIN_DIR), "mirror")
+ONEDIR_DIR = os.path.join(BIN_DIR, ".onedir")  # Unpacked fast-start builds, one directory per version
+DEFAULT_JOBS = 4
+CHUNK_SIZE = 1024 * 1024  # Download chunk size, keeps memory flat regardless of binary size
+DELTA_MAGIC = b"KPZDELTA1\n"  # Must match the format written by back/compile.py
+
+_session = None
+_session_pool_size = 0
+_session_lock = threading.Lock()
 
 def ensure_bin_directory():
     """Ensure the bin directory exists and is in PATH."""
@@ -45,15 +93,89 @@ def ensure_bin_directory():
         # Also update current session PATH
         os.environ["PATH"] = new_path
 
-def get_remote_registry():
-    """Get the registry from the server."""
+def get_session(pool_size=DEFAULT_JOBS):
+    """
+    Get the shared HTTP session so every request reuses pooled connections.
+
+    The connection pool grows to pool_size if an earlier caller asked for a smaller one,
+    so --jobs N threads never share fewer than N connections.
+    """
+    global _session, _session_pool_size
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+        if pool_size > _session_pool_size:
+            _session_pool_size = max(pool_size, 1)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=_session_pool_size)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+def load_cached_manifest():
+    """Load the locally cached manifest along with its fetch time and HTTP validators."""
+    if not os.path.exists(MANIFEST_FILE):
+        return None
+
     try:
-        response = requests.get(f"{SERVER_URL}/registry.txt")
-        response.raise_for_status()
-        return response.text.splitlines()
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching registry: {e}")
+        with open(MANIFEST_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def get_manifest(force=False):
+    """Get the package manifest, revalidating the cached copy only once its TTL has expired.
+
+    Servers without a manifest.json fall back to the flat registry.txt, which
+    lists names only. Returns None if no manifest is available at all.
+    """
+    cached = load_cached_manifest()
+    if cached and cached.get("server") != SERVER_URL:
+        cached = None
+    if cached and not force and time.time() - cached.get("fetched_at", 0) < MANIFEST_TTL:
+        return cached["manifest"]
+
+    headers = {}
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    try:
+        session = get_session()
+        response = session.get(f"{SERVER_URL}/manifest.json", headers=headers)
+        if response.status_code == 304 and cached:
+            manifest = cached["manifest"]
+        elif response.status_code == 404:
+            response = session.get(f"{SERVER_URL}/registry.txt")
+            response.raise_for_status()
+            manifest = {"packages": {name: {} for name in response.text.splitlines() if name.strip()}}
+        else:
+            response.raise_for_status()
+            manifest = response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        if cached:
+            print(f"Error fetching manifest ({e}), using cached copy")
+            return cached["manifest"]
+        print(f"Error fetching manifest: {e}")
+        return None
+
+    os.makedirs(BIN_DIR, exist_ok=True)
+    save_json_atomic(MANIFEST_FILE, {
+        "server": SERVER_URL,
+        "fetched_at": time.time(),
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "manifest": manifest,
+    })
+    return manifest
+
+def get_remote_registry(force=False):
+    """Get the list of packages available on the server."""
+    manifest = get_manifest(force)
+    if manifest is None:
         return []
+    return list(manifest.get("packages", {}))
 
 def get_local_registry():
     """Get the list of locally installed packages."""
@@ -72,7 +194,7 @@ def update():
     """Update the package registry."""
     ensure_bin_directory()
     print("Updating package registry...")
-    remote_registry = get_remote_registry()
+    remote_registry = get_remote_registry(force=True)
 
     if remote_registry:
         print(f"Found {len(remote_registry)} packages on the server.")
@@ -83,21 +205,105 @@ def update():
     else:
         print("No packages found or unable to connect to server.")
 
+def scan_bin_directory():
+    """List executables in BIN_DIR. Only used to adopt binaries installed before the database existed."""
+    # Get locally installed packages based on OS
+    if os.name == 'nt':  # Windows
+        return [os.path.basename(f) for f in os.listdir(BIN_DIR) if os.path.isfile(os.path.join(BIN_DIR, f)) and f.endswith('.exe')]
+
+    # On Linux, executables don't have .exe extension but should have executable permission
+    local_registry = []
+    for f in os.listdir(BIN_DIR):
+        file_path = os.path.join(BIN_DIR, f)
+        if os.path.isfile(file_path) and os.access(file_path, os.X_OK):
+            local_registry.append(f)
+    return local_registry
+
+@contextlib.contextmanager
+def state_lock():
+    """Hold an exclusive lock on the kpz state in BIN_DIR so concurrent runs don't interleave writes."""
+    os.makedirs(BIN_DIR, exist_ok=True)
+    with open(LOCK_FILE, 'a+') as f:
+        if os.name == 'nt':  # Windows
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        else:  # Linux/Unix
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def adopt_installed():
+    """Build install records for binaries in BIN_DIR that are known to the package server."""
+    manifest = get_manifest()
+    known = set(manifest.get("packages", {})) if manifest else set(get_local_registry())
+
+    packages = {}
+    for package in scan_bin_directory():
+        if package not in known:
+            continue
+        package_path = os.path.join(BIN_DIR, package)
+        packages[package] = {
+            "sha256": file_sha256(package_path),
+            "size": os.path.getsize(package_path),
+            "version": None,
+            "installed_at": os.path.getmtime(package_path),
+        }
+    return packages
+
+def read_installed():
+    """Read the installed-package database, or None if it doesn't exist or is unreadable."""
+    if not os.path.exists(INSTALLED_FILE):
+        return None
+
+    try:
+        with open(INSTALLED_FILE, 'r') as f:
+            return json.load(f)["packages"]
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error reading {INSTALLED_FILE} ({e}), rebuilding it from {BIN_DIR}")
+        return None
+
+def load_installed():
+    """Load the installed-package database: name -> sha256, size, version and install time.
+
+    The first run after upgrading from a kpz without the database adopts the
+    binaries already in BIN_DIR.
+    """
+    packages = read_installed()
+    if packages is not None or not os.path.isdir(BIN_DIR):
+        return packages or {}
+
+    with state_lock():
+        packages = read_installed()
+        if packages is None:
+            packages = adopt_installed()
+            save_json_atomic(INSTALLED_FILE, {"packages": packages})
+    return packages
+
+@contextlib.contextmanager
+def installed_transaction():
+    """Lock, load and atomically rewrite the installed-package database.
+
+    Changes made to the yielded dict are only written if the block completes.
+    """
+    with state_lock():
+        packages = read_installed()
+        if packages is None:
+            packages = adopt_installed()
+        yield packages
+        save_json_atomic(INSTALLED_FILE, {"packages": packages})
+
 def list_packages():
     """List available packages."""
     ensure_bin_directory()
-    remote_registry = get_remote_registry()
-
-    # Get locally installed packages based on OS
-    if os.name == 'nt':  # Windows
-        local_registry = [os.path.basename(f) for f in os.listdir(BIN_DIR) if os.path.isfile(os.path.join(BIN_DIR, f)) and f.endswith('.exe')]
-    else:  # Linux/Unix
-        # On Linux, executables don't have .exe extension but should have executable permission
-        local_registry = []
-        for f in os.listdir(BIN_DIR):
-            file_path = os.path.join(BIN_DIR, f)
-            if os.path.isfile(file_path) and os.access(file_path, os.X_OK):
-                local_registry.append(f)
+    manifest = get_manifest()
+    remote_registry = list(manifest.get("packages", {})) if manifest else []
+    installed = load_installed()
 
     if not remote_registry:
         print("No packages available on the server or unable to connect.")
@@ -105,130 +311,1132 @@ def list_packages():
 
     print("Available packages:")
     for package in remote_registry:
-        status = "[installed]" if package in local_registry else "[not installed]"
-        print(f"  {package} {status}")
+        entry = manifest["packages"][package]
+        bundle = installed.get(package, {}).get("bundle")
+        # Linked packages are as current as the bundle they point at
+        current = manifest["packages"].get(bundle, {}) if bundle else entry
+        via = f" via {bundle}" if bundle else ""
+        if installed.get(package, {}).get("onedir"):
+            current = entry.get("onedir") or {}
+            via = ", fast start"
+        if package not in installed:
+            status = "[not installed]"
+        elif current.get("sha256") and installed[package]["sha256"] != current["sha256"]:
+            status = f"[installed{via}, upgradable]"
+        else:
+            status = f"[installed{via}]"
+        details = ""
+        if "version" in entry:
+            details = f" v{entry['version']}, {format_size(entry['size'])}, built {entry['built_at']}"
+        if entry.get("provides"):
+            details += f", bundles {len(entry['provides'])} packages (install with --bundle)"
+        print(f"  {package} {status}{details}")
+
+def stream_to_temp(response, directory, decoder=None):
+    """Stream a response body into a temp file in directory, hashing it on the way.
+
+    With a decoder (see make_decoder) the body is decompressed chunk by chunk
+    as it is written, so compressed downloads never sit in memory either.
+    Returns (temp path, size, sha256, bytes received). The temp file is removed on any failure.
+    """
+    expected = response.headers.get("Content-Length")
+    if response.headers.get("Content-Encoding") and decoder is None:
+        # Sizes no longer match the decoded body
+        expected = None
+
+    if decoder is None:
+        chunks = response.iter_content(CHUNK_SIZE)
+    else:
+        # Hand the raw bytes to our own decoder, even if the server labels them with a Content-Encoding
+        chunks = response.raw.stream(CHUNK_SIZE, decode_content=False)
+
+    fd, tmp_path = tempfile.mkstemp(suffix=".part", dir=directory)
+    try:
+        sha = hashlib.sha256()
+        size = 0
+        received = 0
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                received += len(chunk)
+                if decoder is not None:
+                    chunk = decoder.decompress(chunk)
+                f.write(chunk)
+                sha.update(chunk)
+                size += len(chunk)
+            if decoder is not None:
+                chunk = decoder.flush()
+                f.write(chunk)
+                sha.update(chunk)
+                size += len(chunk)
+                if not getattr(decoder, "eof", True):
+                    raise IOError("truncated compressed download")
+            f.flush()
+            os.fsync(f.fileno())
+
+        if expected is not None and received != int(expected):
+            raise IOError(f"incomplete download ({received} of {expected} bytes)")
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    return tmp_path, size, sha.hexdigest(), received
+
+def pick_encoding(entry):
+    """Pick the best compressed copy the server publishes for a package that this client can decode."""
+    encodings = (entry or {}).get("encodings", {})
+    for encoding in ("zstd", "gzip"):
+        if encoding == "zstd" and zstandard is None:
+            continue
+        if encoding in encodings:
+            return encoding, encodings[encoding]
+    return None, None
+
+def make_decoder(encoding):
+    """Create an incremental decompressor for a published encoding."""
+    if encoding == "gzip":
+        return zlib.decompressobj(wbits=31)
+    return zstandard.ZstdDecompressor().decompressobj()
+
+def format_size(size):
+    """Format a byte count for progress output."""
+    return f"{size / (1024 * 1024):.1f} MB"
+
+def parse_size(text):
+    """Parse a size such as 512M or 2G into bytes."""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def load_http_cache():
+    """Load the ETag/Last-Modified validators recorded for downloaded packages."""
+    if not os.path.exists(HTTP_CACHE_FILE):
+        return {}
+
+    try:
+        with open(HTTP_CACHE_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_json_atomic(path, data):
+    """Atomically rewrite a JSON file."""
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".part",
+                                    dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def save_http_cache(cache):
+    """Atomically rewrite the validator cache."""
+    save_json_atomic(HTTP_CACHE_FILE, cache)
+
+def cache_object_path(sha):
+    """Path of a cached package object, addressed by its SHA-256."""
+    return os.path.join(CACHE_DIR, "objects", sha[:2], sha)
+
+def load_cache_index():
+    """Load the cache index: object sizes/last use and per-package download history."""
+    index = {"objects": {}, "history": {}}
+    if os.path.exists(CACHE_INDEX_FILE):
+        try:
+            with open(CACHE_INDEX_FILE, 'r') as f:
+                index.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    # Forget objects that were deleted behind our back
+    index["objects"] = {sha: entry for sha, entry in index["objects"].items()
+                        if os.path.isfile(cache_object_path(sha))}
+    index["history"] = {package: [sha for sha in shas if sha in index["objects"]]
+                        for package, shas in index["history"].items()}
+    return index
+
+def save_cache_index(index):
+    """Atomically rewrite the cache index."""
+    save_json_atomic(CACHE_INDEX_FILE, index)
+
+def cache_add(tmp_path, sha):
+    """Move a verified temp file into the cache under its hash."""
+    object_path = cache_object_path(sha)
+    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+    if os.name != 'nt':
+        os.chmod(tmp_path, 0o755)
+    if os.path.isfile(object_path):
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, object_path)
+    return object_path
+
+def cache_link(sha, package):
+    """Atomically install a cached object as BIN_DIR/package.
+
+    Hard links are used so the binary is not copied; filesystems without hard
+    link support (or a cache on another device) fall back to a copy.
+    """
+    object_path = cache_object_path(sha)
+    tmp_path = os.path.join(BIN_DIR, f".{package}.{os.getpid()}.{threading.get_ident()}.part")
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(object_path, tmp_path)
+    except OSError:
+        shutil.copy2(object_path, tmp_path)
+    os.replace(tmp_path, os.path.join(BIN_DIR, package))
+
+def link_tool(bundle, package):
+    """Atomically point BIN_DIR/package at the installed multi-call bundle.
+
+    POSIX gets a relative symlink, which keeps following the bundle when it is
+    upgraded. Windows gets a hard link (symlinks need extra privileges), or a
+    copy where hard links aren't supported, so it has to be relinked after
+    every bundle change.
+    """
+    tmp_path = os.path.join(BIN_DIR, f".{package}.{os.getpid()}.link")
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    if os.name == 'nt':  # Windows
+        try:
+            os.link(os.path.join(BIN_DIR, bundle), tmp_path)
+        except OSError:
+            shutil.copy2(os.path.join(BIN_DIR, bundle), tmp_path)
+    else:  # Linux/Mac
+        os.symlink(bundle, tmp_path)
+    os.replace(tmp_path, os.path.join(BIN_DIR, package))
+
+def link_bundle(installed, bundle, packages=None):
+    """Link packages (default: the ones already linked) to bundle and record them in the installed database."""
+    if packages is None:
+        packages = [package for package, record in installed.items() if record.get("bundle") == bundle]
+
+    linked = []
+    for package in packages:
+        try:
+            link_tool(bundle, package)
+            replace_onedir(package, installed.get(package, {}))
+        except OSError as e:
+            print(f"Error linking {package} to {bundle}: {e}")
+            continue
+        installed[package] = {
+            "sha256": installed[bundle]["sha256"],
+            "size": 0,
+            "version": installed[bundle].get("version"),
+            "bundle": bundle,
+            "installed_at": time.time(),
+        }
+        linked.append(package)
+    return linked
+
+def onedir_launcher(package):
+    """Path of what runs an unpacked fast-start package: a symlink on POSIX, a .cmd shim on Windows."""
+    if os.name == 'nt':  # Windows
+        return os.path.join(BIN_DIR, os.path.splitext(package)[0] + ".cmd")
+    return os.path.join(BIN_DIR, package)
+
+def fetch_archive(session, archive):
+    """Get a fast-start archive into the cache, verified against its manifest entry. Returns (sha, transferred)."""
+    sha = archive["sha256"]
+    if os.path.isfile(cache_object_path(sha)):
+        return sha, 0
+    with session.get(f"{SERVER_URL}/{archive['path']}", stream=True) as response:
+        response.raise_for_status()
+        tmp_path, size, got, transferred = stream_to_temp(response, CACHE_DIR)
+    if got != sha or size != archive["size"]:
+        os.remove(tmp_path)
+        raise IOError(f"checksum mismatch (expected {sha[:12]}, got {got[:12]})")
+    cache_add(tmp_path, sha)
+    return sha, transferred
+
+def unpack_onedir(package, sha):
+    """Unpack a cached fast-start archive into its versioned directory and point the package's launcher at it.
+
+    The directory is unpacked next to its final name and renamed into place,
+    so a half-unpacked version is never used. Returns the directory, relative to BIN_DIR.
+    """
+    name = os.path.splitext(package)[0]
+    version_dir = os.path.join(ONEDIR_DIR, f"{name}-{sha[:12]}")
+    if not os.path.isdir(version_dir):
+        tmp_dir = f"{version_dir}.{os.getpid()}.{threading.get_ident()}.part"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        with tarfile.open(cache_object_path(sha), "r:gz") as tar:
+            tar.extractall(tmp_dir, filter="data")
+        os.replace(tmp_dir, version_dir)
+
+    executable = os.path.join(version_dir, name, name + (".exe" if os.name == 'nt' else ""))
+    launcher = onedir_launcher(package)
+    tmp_path = f"{launcher}.{os.getpid()}.{threading.get_ident()}.part"
+    if os.name == 'nt':  # Windows
+        with open(tmp_path, 'w') as f:
+            f.write(f'@"%~dp0{os.path.relpath(executable, BIN_DIR)}" %*\n')
+    else:  # Linux/Mac
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        os.symlink(os.path.relpath(executable, BIN_DIR), tmp_path)
+    os.replace(tmp_path, launcher)
+    # A onefile build left in BIN_DIR would shadow the Windows shim on PATH
+    if launcher != os.path.join(BIN_DIR, package) and os.path.lexists(os.path.join(BIN_DIR, package)):
+        os.remove(os.path.join(BIN_DIR, package))
+    return os.path.relpath(version_dir, BIN_DIR)
+
+def remove_onedir(record, keep=None):
+    """Delete the unpacked directory of a fast-start install unless it is keep. Directories in use may survive."""
+    if record.get("onedir") and record["onedir"] != keep:
+        shutil.rmtree(os.path.join(BIN_DIR, record["onedir"]), ignore_errors=True)
+
+def replace_onedir(package, record):
+    """Clean up after a fast-start install that a plain or bundle install of package has replaced."""
+    if record.get("onedir"):
+        remove_onedir(record)
+        # On POSIX the launcher is BIN_DIR/package itself, which now holds the new install
+        launcher = onedir_launcher(package)
+        if launcher != os.path.join(BIN_DIR, package) and os.path.lexists(launcher):
+            os.remove(launcher)
+
+def install_onedir(packages, manifest, jobs=DEFAULT_JOBS, action="install"):
+    """Install packages from their fast-start archives: downloaded and unpacked once, then run in place."""
+    entries = manifest["packages"]
+    missing = [package for package in packages if not entries.get(package, {}).get("onedir")]
+    for package in missing:
+        print(f"Package '{package}' has no fast-start build on the server.")
+    packages = [package for package in packages if package not in missing]
+    if not packages:
+        return not missing
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    jobs = max(1, min(jobs, len(packages)))
+    session = get_session(jobs)
+    verb, done = ("Installing", "installed") if action == "install" else ("Upgrading", "upgraded")
+    print(f"{verb} {len(packages)} fast-start package(s) using {jobs} parallel download(s)...")
+    started = time.monotonic()
+
+    fetched = {}
+    succeeded = []
+    unchanged = []
+    failed = list(missing)
+    transferred = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(fetch_archive, session, entries[package]["onedir"]): package for package in packages}
+        for future in as_completed(futures):
+            package = futures[future]
+            try:
+                fetched[package], size = future.result()
+                transferred += size
+            except (requests.exceptions.RequestException, OSError) as e:
+                print(f"Error downloading {package}: {e}")
+                failed.append(package)
+
+    index = load_cache_index()
+    with installed_transaction() as installed:
+        for package, sha in sorted(fetched.items()):
+            previous = installed.get(package, {})
+            if previous.get("sha256") == sha and os.path.lexists(onedir_launcher(package)):
+                print(f"{package} is up to date")
+                unchanged.append(package)
+                continue
+            try:
+                version_dir = unpack_onedir(package, sha)
+            except (OSError, tarfile.TarError) as e:
+                print(f"Error unpacking {package}: {e}")
+                failed.append(package)
+                continue
+            remove_onedir(previous, keep=version_dir)
+            cache_record(index, package + ".onedir", sha, entries[package]["onedir"]["size"])
+            installed[package] = {
+                "sha256": sha,
+                "size": entries[package]["onedir"]["size"],
+                "version": entries[package].get("version"),
+                "onedir": version_dir,
+                "installed_at": time.time(),
+            }
+            print(f"Successfully {done} {package} into {version_dir}")
+            succeeded.append(package)
+        protected = {record["sha256"] for record in installed.values()}
+    cache_evict(index, protected=protected)
+    save_cache_index(index)
+
+    print(f"{len(succeeded)} {done}, {len(unchanged)} up to date, {len(failed)} failed "
+          f"in {time.monotonic() - started:.1f}s, transferred {format_size(transferred)}")
+    return not failed
+
+def cache_record(index, package, sha, size):
+    """Mark an object as used by package, newest first in the package history."""
+    index["objects"][sha] = {"size": size, "last_used": time.time()}
+    history = [item for item in index["history"].get(package, []) if item != sha]
+    index["history"][package] = [sha] + history
+
+def cache_evict(index, max_size=None, protected=()):
+    """Evict least recently used objects until the cache fits max_size.
+
+    Objects in protected (the installed builds) and objects that are still
+    hard-linked into BIN_DIR are never evicted.
+    Returns (number of evicted objects, bytes freed).
+    """
+    if max_size is None:
+        max_size = parse_size(CACHE_MAX_SIZE)
+
+    total = sum(entry["size"] for entry in index["objects"].values())
+    evicted = 0
+    freed = 0
+    for sha, entry in sorted(index["objects"].items(), key=lambda item: item[1]["last_used"]):
+        if total <= max_size:
+            break
+        object_path = cache_object_path(sha)
+        if sha in protected or os.stat(object_path).st_nlink > 1:
+            continue
+        os.remove(object_path)
+        del index["objects"][sha]
+        total -= entry["size"]
+        evicted += 1
+        freed += entry["size"]
+
+    for package in index["history"]:
+        index["history"][package] = [sha for sha in index["history"][package] if sha in index["objects"]]
+    return evicted, freed
+
+def file_sha256(path):
+    """Compute the SHA-256 of a file without reading it into memory at once."""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def read_exact(stream, size):
+    """Read exactly size bytes from a stream or fail on truncated input."""
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError("truncated delta")
+    return data
+
+def apply_delta(delta_path, source_path):
+    """Rebuild a package from a previous build and a delta into a verified temp file in CACHE_DIR.
+
+    Returns (temp path, size, sha256).
+    """
+    with open(delta_path, 'rb') as delta:
+        if delta.read(len(DELTA_MAGIC)) != DELTA_MAGIC:
+            raise ValueError("not a KPZ delta")
+        header = json.loads(delta.readline())
+
+        fd, tmp_path = tempfile.mkstemp(suffix=".part", dir=CACHE_DIR)
+        try:
+            sha = hashlib.sha256()
+            size = 0
+            with open(source_path, 'rb') as source, gzip.GzipFile(fileobj=delta, mode='rb') as ops, \
+                    os.fdopen(fd, 'wb') as out:
+                while True:
+                    kind = ops.read(1)
+                    if not kind:
+                        break
+                    if kind == b"C":
+                        offset, length = struct.unpack(">QQ", read_exact(ops, 16))
+                        source.seek(offset)
+                        reader = source
+                    elif kind == b"A":
+                        (length,) = struct.unpack(">Q", read_exact(ops, 8))
+                        reader = ops
+                    else:
+                        raise ValueError(f"unknown delta op {kind!r}")
+
+                    while length:
+                        chunk = read_exact(reader, min(length, CHUNK_SIZE))
+                        out.write(chunk)
+                        sha.update(chunk)
+                        size += len(chunk)
+                        length -= len(chunk)
+
+            if size != header["target_size"] or sha.hexdigest() != header["target_sha256"]:
+                raise ValueError("hash mismatch after applying delta")
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    return tmp_path, size, sha.hexdigest()
+
+def fetch_delta(session, package, source_path, source_sha):
+    """Try to rebuild the current release of a package from source_path and a published delta.
+
+    Returns (temp path, size, sha256, bytes transferred), or None if no usable delta exists.
+    """
+    delta_path = None
+    try:
+        with session.get(f"{SERVER_URL}/deltas/{package}/{source_sha}.delta", stream=True) as response:
+            if response.status_code == 404:
+                return None
+            response.raise_for_status()
+            delta_path, _, _, transferred = stream_to_temp(response, CACHE_DIR)
+
+        tmp_path, size, sha = apply_delta(delta_path, source_path)
+    except (requests.exceptions.RequestException, OSError, ValueError, KeyError, struct.error, EOFError, zlib.error) as e:
+        print(f"Delta for {package} failed ({e}), falling back to a full download")
+        return None
+    finally:
+        if delta_path is not None and os.path.exists(delta_path):
+            os.remove(delta_path)
 
-def install(packages):
+    return tmp_path, size, sha, transferred
+
+def conditional_headers(validators):
+    """Build If-None-Match/If-Modified-Since headers if the validated build is still cached."""
+    if not validators or not os.path.isfile(cache_object_path(validators.get("sha256", ""))):
+        return {}
+
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+def fetch_package(session, package, validators=None, history=(), expected=None, installed=None, compression=True):
+    """Bring BIN_DIR/package up to date with the server without buffering it in memory.
+
+    The installed record tells which build is in BIN_DIR without hashing it.
+    When the manifest entry (expected) carries a hash, installed and cached builds
+    are recognised without any request and downloads are verified against it.
+    Otherwise the cached copy is reused when a conditional HEAD reports it unchanged.
+    Changed packages are rebuilt from a delta of the installed (or last cached)
+    build when possible, and downloaded in full if not - compressed, if the server
+    publishes a copy this client can decode and compression is enabled.
+    Returns a dict with the installed sha256, size, bytes transferred, how it was
+    obtained ("current", "cache", "delta" or "download"), the encoding used, the
+    time spent and the new HTTP validators.
+    """
+    started = time.monotonic()
+    expected = expected or {}
+    url = f"{SERVER_URL}/{package}"
+    package_path = os.path.join(BIN_DIR, package)
+    want = expected.get("sha256")
+    current = installed["sha256"] if installed and os.path.isfile(package_path) else None
+    if want:
+        if current == want:
+            return {"sha256": want, "size": expected["size"], "transferred": 0, "source": "current",
+                    "validators": validators}
+        if os.path.isfile(cache_object_path(want)):
+            cache_link(want, package)
+            return {"sha256": want, "size": expected["size"], "transferred": 0, "source": "cache",
+                    "validators": validators}
+    else:
+        headers = conditional_headers(validators)
+        if headers:
+            response = session.head(url, headers=headers)
+            if response.status_code == 304:
+                sha = validators["sha256"]
+                source = "current"
+                if current != sha:
+                    cache_link(sha, package)
+                    source = "cache"
+                return {"sha256": sha, "size": validators["size"], "transferred": 0, "source": source,
+                        "validators": validators}
+
+    source_path, source_sha = None, None
+    if current is not None:
+        source_path, source_sha = package_path, current
+    elif history:
+        source_path, source_sha = cache_object_path(history[0]), history[0]
+
+    delta = None
+    encoding = None
+    if source_path is not None:
+        # With a manifest, only ask for deltas the server says it has
+        if not want or source_sha in expected.get("deltas", []):
+            delta = fetch_delta(session, package, source_path, source_sha)
+
+    if delta is not None:
+        tmp_path, size, sha, transferred = delta
+        source = "delta"
+        # The delta doesn't carry the full artifact's validators
+        response = session.head(url)
+        response_headers = response.headers if response.ok else {}
+    else:
+        source = "download"
+        encoding, encoded = pick_encoding(expected) if compression else (None, None)
+        if encoded is not None:
+            try:
+                with session.get(f"{SERVER_URL}/{encoded['path']}", stream=True) as response:
+                    response.raise_for_status()
+                    tmp_path, size, sha, transferred = stream_to_temp(response, CACHE_DIR, make_decoder(encoding))
+                # Validators of the compressed copy don't describe the full artifact
+                response_headers = {}
+            except COMPRESSED_DOWNLOAD_ERRORS as e:
+                print(f"Compressed download of {package} failed ({e}), downloading it uncompressed")
+                encoding = None
+        if encoding is None:
+            with session.get(url, stream=True) as response:
+                response.raise_for_status()
+                tmp_path, size, sha, transferred = stream_to_temp(response, CACHE_DIR)
+                response_headers = response.headers
+
+    if want and (sha != want or size != expected.get("size", size)):
+        os.remove(tmp_path)
+        raise IOError(f"checksum mismatch (expected {want[:12]}, got {sha[:12]})")
+
+    cache_add(tmp_path, sha)
+    cache_link(sha, package)
+    validators = {
+        "sha256": sha,
+        "size": size,
+        "etag": response_headers.get("ETag"),
+        "last_modified": response_headers.get("Last-Modified"),
+    }
+    return {"sha256": sha, "size": size, "transferred": transferred, "source": source,
+            "encoding": encoding, "elapsed": time.monotonic() - started, "validators": validators}
+
+def describe_transfer(result):
+    """Describe how a full download was transferred: encoding, compression ratio and throughput."""
+    elapsed = max(result["elapsed"], 1e-6)
+    wire = f"{format_size(result['transferred'] / elapsed)}/s on the wire"
+    if result["encoding"] is None:
+        return f", uncompressed, {wire}"
+    ratio = result["size"] / max(result["transferred"], 1)
+    return (f", {result['encoding']} {format_size(result['transferred'])}, ratio {ratio:.2f}x, "
+            f"{wire}, {format_size(result['size'] / elapsed)}/s effective")
+
+def download_packages(packages, jobs=DEFAULT_JOBS, action="install", manifest=None, compression=True):
+    """Download packages concurrently over one pooled session and report per-package results.
+
+    Every build goes through the local cache. With a manifest, unchanged packages
+    cost no request at all; without one they cost a conditional HEAD request.
+    Changed packages are rebuilt from a delta when the server has one, or downloaded
+    compressed when possible; the compression ratio and throughput are reported.
+    """
+    if not packages:
+        return [], []
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    jobs = max(1, min(jobs, len(packages)))
+    session = get_session(jobs)
+    verb, done = ("Installing", "installed") if action == "install" else ("Upgrading", "upgraded")
+    print(f"{verb} {len(packages)} package(s) using {jobs} parallel download(s)...")
+
+    http_cache = load_http_cache()
+    index = load_cache_index()
+    installed = load_installed()
+    packages_info = manifest.get("packages", {}) if manifest else {}
+    records = {}
+
+    succeeded = []
+    unchanged = []
+    failed = []
+    transferred = 0
+    saved = 0
+    downloaded = 0
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(fetch_package, session, package, http_cache.get(package),
+                            index["history"].get(package, []), packages_info.get(package),
+                            installed.get(package), compression): package
+            for package in packages
+        }
+        for future in as_completed(futures):
+            package = futures[future]
+            try:
+                result = future.result()
+            except (requests.exceptions.RequestException, OSError) as e:
+                print(f"Error downloading {package}: {e}")
+                failed.append(package)
+                continue
+
+            cache_record(index, package, result["sha256"], result["size"])
+            records[package] = result
+            if result["validators"]:
+                http_cache[package] = result["validators"]
+            transferred += result["transferred"]
+            saved += result["size"] - result["transferred"]
+
+            if result["source"] == "current":
+                print(f"{package} is up to date")
+                unchanged.append(package)
+            elif result["source"] == "cache":
+                # A different build than the installed one, linked in from the cache
+                print(f"Successfully {done} {package} from cache")
+                succeeded.append(package)
+            elif result["source"] == "delta":
+                print(f"Successfully {done} {package} via delta "
+                      f"({format_size(result['transferred'])} of {format_size(result['size'])})")
+                succeeded.append(package)
+            else:
+                print(f"Successfully {done} {package} ({format_size(result['size'])}{describe_transfer(result)})")
+                succeeded.append(package)
+                downloaded += result["size"]
+
+    with installed_transaction() as db:
+        for package, result in records.items():
+            previous = db.get(package, {})
+            if previous.get("sha256") == result["sha256"] and os.path.isfile(os.path.join(BIN_DIR, package)):
+                continue
+            try:
+                replace_onedir(package, previous)
+            except OSError as e:
+                print(f"Error removing the fast-start install of {package}: {e}")
+            db[package] = {
+                "sha256": result["sha256"],
+                "size": result["size"],
+                "version": packages_info.get(package, {}).get("version"),
+                "installed_at": time.time(),
+            }
+        protected = {record["sha256"] for record in db.values()}
+
+    cache_evict(index, protected=protected)
+    save_cache_index(index)
+    save_http_cache(http_cache)
+
+    elapsed = time.monotonic() - started
+    print(f"{len(succeeded)} {done}, {len(unchanged)} up to date, {len(failed)} failed in {elapsed:.1f}s")
+    print(f"Transferred {format_size(transferred)}, saved {format_size(saved)} through the cache, deltas and compression")
+    if downloaded and elapsed > 0:
+        print(f"Throughput: {format_size(transferred / elapsed)}/s on the wire, "
+              f"{format_size((saved + transferred) / elapsed)}/s of installed packages")
+    if failed:
+        print(f"Failed: {', '.join(sorted(failed))}")
+    return succeeded + unchanged, failed
+
+def install_bundle(packages, manifest, jobs=DEFAULT_JOBS, compression=True):
+    """Install the multi-call bundle once and link the requested packages to it."""
+    bundles = {name: entry["provides"] for name, entry in manifest["packages"].items() if entry.get("provides")}
+    if not bundles:
+        print("The server doesn't publish a multi-call bundle.")
+        return False
+
+    bundle = sorted(bundles)[0]
+    if len(packages) == 1 and packages[0] == 'all':
+        packages = bundles[bundle]
+    missing = [package for package in packages if package not in bundles[bundle]]
+    for package in missing:
+        print(f"Package '{package}' is not part of {bundle}.")
+    packages = [package for package in dict.fromkeys(packages) if package not in missing]
+    if not packages:
+        return False
+
+    _, failed = download_packages([bundle], jobs, "install", manifest, compression)
+    if failed:
+        return False
+
+    with installed_transaction() as installed:
+        linked = link_bundle(installed, bundle, packages)
+    print(f"Linked {len(linked)} package(s) to {bundle}: {', '.join(linked)}")
+    return len(linked) == len(packages) and not missing
+
+def install(packages, jobs=DEFAULT_JOBS, compression=True, bundle=False, onedir=False):
     """Install specified packages."""
     ensure_bin_directory()
-    remote_registry = get_remote_registry()
+    manifest = get_manifest()
+    remote_registry = list(manifest.get("packages", {})) if manifest else []
 
     if not remote_registry:
         print("No packages available on the server or unable to connect.")
-        return
+        return False
 
     if not packages:
         print("No packages specified for installation.")
-        return
+        return True
+
+    if bundle:
+        return install_bundle(packages, manifest, jobs, compression)
 
     # If 'all' is specified, install all packages
     if len(packages) == 1 and packages[0] == 'all':
         packages = remote_registry
 
+    to_download = []
     for package in packages:
         if package not in remote_registry:
             print(f"Package '{package}' not found on the server.")
             continue
+        if package not in to_download:
+            to_download.append(package)
 
-        print(f"Downloading {package}...")
-        try:
-            response = requests.get(f"{SERVER_URL}/{package}")
-            response.raise_for_status()
-
-            package_path = os.path.join(BIN_DIR, package)
-            with open(package_path, 'wb') as f:
-                f.write(response.content)
-
-            # Make the file executable (for Unix-like systems)
-            if os.name != 'nt':
-                os.chmod(package_path, 0o755)
-
-            print(f"Successfully installed {package}")
-        except requests.exceptions.RequestException as e:
-            print(f"Error downloading {package}: {e}")
+    if onedir:
+        return install_onedir(to_download, manifest, jobs)
+    _, failed = download_packages(to_download, jobs, "install", manifest, compression)
+    return not failed
 
 def remove(packages):
     """Remove specified packages."""
     ensure_bin_directory()
 
-    # Get locally installed packages based on OS
-    if os.name == 'nt':  # Windows
-        local_registry = [os.path.basename(f) for f in os.listdir(BIN_DIR) if os.path.isfile(os.path.join(BIN_DIR, f)) and f.endswith('.exe')]
-    else:  # Linux/Unix
-        # On Linux, executables don't have .exe extension but should have executable permission
-        local_registry = []
-        for f in os.listdir(BIN_DIR):
-            file_path = os.path.join(BIN_DIR, f)
-            if os.path.isfile(file_path) and os.access(file_path, os.X_OK):
-                local_registry.append(f)
-
     if not packages:
         print("No packages specified for removal.")
         return
 
-    # If 'all' is specified, remove all packages
-    if len(packages) == 1 and packages[0] == 'all':
-        packages = local_registry
+    with installed_transaction() as installed:
+        # If 'all' is specified, remove all packages
+        if len(packages) == 1 and packages[0] == 'all':
+            packages = list(installed)
 
-    for package in packages:
-        package_path = os.path.join(BIN_DIR, package)
-        if os.path.exists(package_path):
-            try:
-                os.remove(package_path)
-                print(f"Successfully removed {package}")
-            except OSError as e:
-                print(f"Error removing {package}: {e}")
-        else:
-            print(f"Package '{package}' is not installed.")
+        removed = set()
+        for package in packages:
+            if package in removed:
+                continue
+            if package not in installed:
+                print(f"Package '{package}' is not installed.")
+                continue
+
+            # Removing a bundle also removes the packages linked to it
+            linked = [name for name, record in installed.items() if record.get("bundle") == package]
+            for name in linked + [package]:
+                package_path = os.path.join(BIN_DIR, name)
+                try:
+                    if installed[name].get("onedir"):
+                        package_path = onedir_launcher(name)
+                        remove_onedir(installed[name])
+                    if os.path.lexists(package_path):
+                        os.remove(package_path)
+                    del installed[name]
+                    removed.add(name)
+                    print(f"Successfully removed {name}")
+                except OSError as e:
+                    print(f"Error removing {name}: {e}")
 
-def upgrade():
+def upgrade(jobs=DEFAULT_JOBS, compression=True):
     """Upgrade all installed packages."""
     ensure_bin_directory()
-    remote_registry = get_remote_registry()
-
-    # Get locally installed packages based on OS
-    if os.name == 'nt':  # Windows
-        local_registry = [os.path.basename(f) for f in os.listdir(BIN_DIR) if os.path.isfile(os.path.join(BIN_DIR, f)) and f.endswith('.exe')]
-    else:  # Linux/Unix
-        # On Linux, executables don't have .exe extension but should have executable permission
-        local_registry = []
-        for f in os.listdir(BIN_DIR):
-            file_path = os.path.join(BIN_DIR, f)
-            if os.path.isfile(file_path) and os.access(file_path, os.X_OK):
-                local_registry.append(f)
+    manifest = get_manifest()
+    remote_registry = list(manifest.get("packages", {})) if manifest else []
+    local_registry = sorted(load_installed())
 
     if not remote_registry:
         print("No packages available on the server or unable to connect.")
-        return
+        return False
 
     if not local_registry:
         print("No packages are currently installed.")
-        return
+        return True
 
     print("Upgrading installed packages...")
+    installed = load_installed()
+    to_download = []
+    fast_start = []
+    seen = set()
     for package in local_registry:
-        if package in remote_registry:
-            print(f"Upgrading {package}...")
-            try:
-                response = requests.get(f"{SERVER_URL}/{package}")
-                response.raise_for_status()
+        # Linked packages are upgraded through their bundle
+        package = installed[package].get("bundle", package)
+        if package in seen:
+            continue
+        seen.add(package)
+        record = installed.get(package)
+        if record is None:
+            print(f"Package '{package}' is not installed.")
+        elif package not in remote_registry:
+            print(f"Package '{package}' is no longer available on the server.")
+        elif record.get("onedir"):
+            fast_start.append(package)
+        else:
+            to_download.append(package)
+
+    _, failed = download_packages(to_download, jobs, "upgrade", manifest, compression)
+    success = not failed
+    if fast_start and not install_onedir(fast_start, manifest, jobs, "upgrade"):
+        success = False
+    with installed_transaction() as installed:
+        for bundle in {record["bundle"] for record in installed.values() if record.get("bundle")}:
+            if bundle in installed:
+                link_bundle(installed, bundle)
+    return success
+
+def rollback(packages):
+    """Reinstall the previous cached build of the specified packages."""
+    ensure_bin_directory()
+    index = load_cache_index()
+
+    success = True
+    with installed_transaction() as installed:
+        for package in packages:
+            if package not in installed:
+                print(f"Package '{package}' is not installed.")
+                success = False
+                continue
+
+            # Fast-start installs keep their archive history under a separate name
+            onedir = installed[package].get("onedir")
+            history = index["history"].get(package + ".onedir" if onedir else package, [])
+            current = installed[package]["sha256"]
+            older = history[history.index(current) + 1:] if current in history else history
+            if not older:
+                print(f"No earlier build of {package} in the cache.")
+                success = False
+                continue
+
+            sha = older[0]
+            record = {
+                "sha256": sha,
+                "size": index["objects"][sha]["size"],
+                "version": None,
+                "installed_at": time.time(),
+            }
+            if onedir:
+                record["onedir"] = unpack_onedir(package, sha)
+                remove_onedir(installed[package], keep=record["onedir"])
+            else:
+                cache_link(sha, package)
+            index["objects"][sha]["last_used"] = time.time()
+            installed[package] = record
+            print(f"Rolled back {package} to build {sha[:12]}")
+            link_bundle(installed, package)
 
-                package_path = os.path.join(BIN_DIR, package)
-                with open(package_path, 'wb') as f:
-                    f.write(response.content)
+    save_cache_index(index)
+    return success
 
-                # Make the file executable (for Unix-like systems)
-                if os.name != 'nt':
-                    os.chmod(package_path, 0o755)
+def cache_stats():
+    """Print the contents and size of the package cache."""
+    index = load_cache_index()
+    total = sum(entry["size"] for entry in index["objects"].values())
+    installed_shas = {record["sha256"] for record in load_installed().values()}
+    linked = sum(1 for sha in index["objects"] if sha in installed_shas)
 
-                print(f"Successfully upgraded {package}")
-            except requests.exceptions.RequestException as e:
-                print(f"Error upgrading {package}: {e}")
+    print(f"Cache directory: {CACHE_DIR}")
+    print(f"Objects: {len(index['objects'])} ({linked} installed), "
+          f"{format_size(total)} of {format_size(parse_size(CACHE_MAX_SIZE))} limit")
+    for package, history in sorted(index["history"].items()):
+        if history:
+            builds = ", ".join(sha[:12] for sha in history)
+            print(f"  {package}: {len(history)} build(s) [{builds}]")
+
+def cache_prune(max_size=None):
+    """Evict least recently used cache objects down to max_size (default: the configured cap)."""
+    if not os.path.isdir(CACHE_DIR):
+        print("The package cache is empty.")
+        return
+
+    index = load_cache_index()
+    protected = {record["sha256"] for record in load_installed().values()}
+    evicted, freed = cache_evict(index, parse_size(max_size) if max_size is not None else None, protected)
+    save_cache_index(index)
+    print(f"Evicted {evicted} object(s), freed {format_size(freed)}")
+
+class MirrorRequestHandler(BaseHTTPRequestHandler):
+    """Serve files from the mirror directory, fetching each one from upstream at most once.
+
+    Files are revalidated against upstream once they are older than MANIFEST_TTL,
+    except package binaries (and their compressed copies) whose hash still
+    matches the upstream manifest.
+    Responses support conditional requests (ETag/Last-Modified) and byte ranges.
+    """
+    upstream = SERVER_URL
+    mirror_dir = MIRROR_DIR
+    _locks = {}
+    _locks_guard = threading.Lock()
+
+    def do_GET(self):
+        self.serve(send_body=True)
+
+    def do_HEAD(self):
+        self.serve(send_body=False)
+
+    def serve(self, send_body):
+        rel_path = self.resolve_path()
+        if rel_path is None:
+            self.send_error(404)
+            return
+
+        try:
+            meta = self.ensure_cached(rel_path)
+        except requests.exceptions.RequestException as e:
+            self.send_error(502, f"Upstream error: {e}")
+            return
+        if meta is None:
+            self.send_error(404)
+            return
+
+        path = os.path.join(self.mirror_dir, rel_path)
+        etag = f'"{meta["sha256"]}"'
+        mtime = os.path.getmtime(path)
+        if self.not_modified(etag, mtime):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        byte_range = self.parse_range(size, etag)
+        if byte_range == "invalid":
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.end_headers()
+            return
+        if byte_range is not None:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
         else:
-            print(f"Package '{package}' is no longer available on the server.")
+            self.send_response(200)
+
+        self.send_header("Content-Type", "application/json" if rel_path.endswith(".json") else "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", email.utils.formatdate(mtime, usegmt=True))
+        self.end_headers()
+
+        if send_body:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining:
+                    chunk = f.read(min(remaining, CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+
+    def resolve_path(self):
+        """Map the request path to a relative path inside the mirror, rejecting traversal."""
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        parts = [part for part in path.split("/") if part]
+        if not parts or any(part in ("..", ".") or part.startswith(".") for part in parts):
+            return None
+        return os.path.join(*parts)
+
+    def not_modified(self, etag, mtime):
+        """Evaluate If-None-Match / If-Modified-Since against the cached file."""
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            return etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since
+        return False
+
+    def parse_range(self, size, etag):
+        """Parse a single "bytes=" range. Returns (start, end), None for the full body, or "invalid"."""
+        header = self.headers.get("Range")
+        if not header or not header.startswith("bytes=") or "," in header:
+            return None
+        if_range = self.headers.get("If-Range")
+        if if_range is not None and if_range.strip() != etag:
+            return None
+
+        first, _, last = header[len("bytes="):].strip().partition("-")
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else size - 1
+            else:
+                start = max(size - int(last), 0)
+                end = size - 1
+        except ValueError:
+            return None
+        end = min(end, size - 1)
+        if start > end or start >= size:
+            return "invalid"
+        return start, end
+
+    def path_lock(self, rel_path):
+        with self._locks_guard:
+            return self._locks.setdefault(rel_path, threading.Lock())
+
+    def meta_path(self, rel_path):
+        return os.path.join(self.mirror_dir, ".meta", rel_path + ".json")
+
+    def load_meta(self, rel_path):
+        try:
+            with open(self.meta_path(rel_path), 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return meta if os.path.isfile(os.path.join(self.mirror_dir, rel_path)) else None
+
+    def is_fresh(self, rel_path, meta):
+        """Check whether a cached file can be served without asking upstream."""
+        if time.time() - meta["fetched_at"] < MANIFEST_TTL:
+            return True
+        if rel_path in ("manifest.json", "registry.txt"):
+            return False
+
+        # Package binaries stay valid for as long as the upstream manifest lists their hash
+        manifest = self.ensure_cached("manifest.json")
+        if manifest is None:
+            return False
+        with open(os.path.join(self.mirror_dir, "manifest.json"), 'r') as f:
+            packages = json.load(f).get("packages", {})
+        name = rel_path.replace(os.sep, "/")
+        for package, entry in packages.items():
+            if package == name:
+                return entry.get("sha256") == meta["sha256"]
+            for encoded in [*entry.get("encodings", {}).values(), entry.get("onedir") or {}]:
+                if encoded.get("path") == name:
+                    return encoded.get("sha256") == meta["sha256"]
+        return False
+
+    def ensure_cached(self, rel_path):
+        """Make sure rel_path is in the mirror and current. Returns its metadata, or None if upstream has no such file."""
+        with self.path_lock(rel_path):
+            meta = self.load_meta(rel_path)
+            if meta is not None and self.is_fresh(rel_path, meta):
+                return meta
+
+            headers = {}
+            if meta is not None:
+                if meta.get("etag"):
+                    headers["If-None-Match"] = meta["etag"]
+                if meta.get("last_modified"):
+                    headers["If-Modified-Since"] = meta["last_modified"]
+
+            path = os.path.join(self.mirror_dir, rel_path)
+            try:
+                with get_session().get(f"{self.upstream}/{rel_path.replace(os.sep, '/')}", headers=headers,
+                                       stream=True) as response:
+                    if response.status_code == 304 and meta is not None:
+                        meta["fetched_at"] = time.time()
+                    elif response.status_code == 404:
+                        if meta is not None:
+                            os.remove(path)
+                            os.remove(self.meta_path(rel_path))
+                        return None
+                    else:
+                        response.raise_for_status()
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        tmp_path, size, sha, _ = stream_to_temp(response, os.path.dirname(path))
+                        os.replace(tmp_path, path)
+                        meta = {
+                            "sha256": sha,
+                            "size": size,
+                            "etag": response.headers.get("ETag"),
+                            "last_modified": response.headers.get("Last-Modified"),
+                            "fetched_at": time.time(),
+                        }
+                        print(f"Mirrored {rel_path} ({format_size(size)}) from {self.upstream}")
+            except requests.exceptions.RequestException:
+                if meta is None:
+                    raise
+                # Keep serving the last good copy while upstream is unreachable
+                return meta
+
+            os.makedirs(os.path.dirname(self.meta_path(rel_path)), exist_ok=True)
+            save_json_atomic(self.meta_path(rel_path), meta)
+            return meta
+
+def serve(host, port, upstream, mirror_dir):
+    """Run a caching mirror of the package server."""
+    if upstream.rstrip("/") == f"http://{host}:{port}":
+        print("The mirror cannot use itself as upstream.")
+        return False
+
+    os.makedirs(mirror_dir, exist_ok=True)
+    MirrorRequestHandler.upstream = upstream.rstrip("/")
+    MirrorRequestHandler.mirror_dir = os.path.abspath(mirror_dir)
+    server = ThreadingHTTPServer((host, port), MirrorRequestHandler)
+    print(f"Mirroring {MirrorRequestHandler.upstream} on http://{host}:{port} (cache: {MirrorRequestHandler.mirror_dir})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return True
 
 def main():
+    global SERVER_URL
     parser = argparse.ArgumentParser(description='KPZ Package manager for downloading and managing executables')
+    parser.add_argument('--server', help=f'Package server URL (default: $KPZ_SERVER_URL or {SERVER_URL})')
     subparsers = parser.add_subparsers(dest='command', help='Command to execute')
 
     # Update command
@@ -240,6 +1448,12 @@ def main():
     # Install command
     install_parser = subparsers.add_parser('install', help='Install packages')
     install_parser.add_argument('packages', nargs='+', help='Packages to install (use "all" to install all packages)')
+    install_parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS, help=f'Number of parallel downloads (default: {DEFAULT_JOBS})')
+    install_parser.add_argument('--no-compression', action='store_true', help='Download uncompressed binaries')
+    install_parser.add_argument('--bundle', action='store_true',
+                                help='Install the multi-call bundle once and link the packages to it')
+    install_parser.add_argument('--fast-start', action='store_true',
+                                help='Install the onedir builds, unpacked once under bin/ instead of on every run')
 
     # Remove command
     remove_parser = subparsers.add_parser('remove', help='Remove packages')
@@ -247,19 +1461,53 @@ def main():
 
     # Upgrade command
     upgrade_parser = subparsers.add_parser('upgrade', help='Upgrade all installed packages')
+    upgrade_parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS, help=f'Number of parallel downloads (default: {DEFAULT_JOBS})')
+    upgrade_parser.add_argument('--no-compression', action='store_true', help='Download uncompressed binaries')
+
+    # Rollback command
+    rollback_parser = subparsers.add_parser('rollback', help='Reinstall the previous cached build of packages')
+    rollback_parser.add_argument('packages', nargs='+', help='Packages to roll back')
+
+    # Cache command
+    cache_parser = subparsers.add_parser('cache', help='Inspect or prune the local package cache')
+    cache_parser.add_argument('action', choices=['stats', 'prune'], help='Cache action to perform')
+    cache_parser.add_argument('--max-size', help=f'Size to prune down to, e.g. 500M (default: {CACHE_MAX_SIZE})')
+
+    # Serve command
+    serve_parser = subparsers.add_parser('serve', help='Run a caching mirror of the package server')
+    serve_parser.add_argument('--host', default='0.0.0.0', help='Address to listen on (default: 0.0.0.0)')
+    serve_parser.add_argument('--port', type=int, default=8080, help='Port to listen on (default: 8080)')
+    serve_parser.add_argument('--upstream', help='Server to mirror (default: the configured server URL)')
+    serve_parser.add_argument('--mirror-dir', default=MIRROR_DIR, help=f'Where mirrored files are stored (default: {MIRROR_DIR})')
 
     args = parser.parse_args()
 
+    if args.server:
+        SERVER_URL = args.server.rstrip("/")
+
     if args.command == 'update':
         update()
     elif args.command == 'list':
         list_packages()
     elif args.command == 'install':
-        install(args.packages)
+        if not install(args.packages, args.jobs, not args.no_compression, args.bundle, args.fast_start):
+            sys.exit(1)
     elif args.command == 'remove':
         remove(args.packages)
     elif args.command == 'upgrade':
-        upgrade()
+        if not upgrade(args.jobs, not args.no_compression):
+            sys.exit(1)
+    elif args.command == 'rollback':
+        if not rollback(args.packages):
+            sys.exit(1)
+    elif args.command == 'cache':
+        if args.action == 'stats':
+            cache_stats()
+        else:
+            cache_prune(args.max_size)
+    elif args.command == 'serve':
+        if not serve(args.host, args.port, args.upstream or SERVER_URL, args.mirror_dir):
+            sys.exit(1)
     else:
         parser.print_help()
 
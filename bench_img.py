@@ -0,0 +1,225 @@
+"""
+Benchmarks for the image operations of back/pkgs/img.py.
+
+By default every operation is called in-process on synthetic images of
+several sizes and channel counts, and its throughput is reported in
+megapixels per second. --cli instead times whole runs of the img command line,
+start-up included. Results can be written to JSON (--json) and compared with
+an earlier run (--compare), e.g. the same benchmark on the previous commit:
+
+    python3 bench_img.py --json before.json
+    python3 bench_img.py --compare before.json
+    python3 bench_img.py --cli --command dist/img.exe
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+IMG_SCRIPT = os.path.join(ROOT, "back", "pkgs", "img.py")
+sys.path.insert(0, os.path.dirname(IMG_SCRIPT))
+
+import img
+
+img.load_imaging()
+cv2 = img.cv2
+np = img.np
+
+SIZES = {'small': (640, 480), 'medium': (1920, 1080), 'large': (4000, 3000)}
+CHANNELS = [1, 3, 4]
+MIN_RUNS = 5
+MIN_TIME = 0.5  # Seconds each case is repeated for, at least MIN_RUNS times
+COMPARE_THRESHOLD = 0.1  # Slowdown of the median time that counts as a regression
+
+def crop_copy(image):
+    # crop_image returns a view; copy it so the benchmark measures producing the pixels
+    h, w = image.shape[:2]
+    return img.crop_image(image, w // 4, h // 4, w // 2, h // 2).copy()
+
+# Operation name -> call on a decoded image, with typical parameters
+OPERATIONS = {
+    'resize': lambda image: img.resize_image(image, scale=0.5),
+    'rotate': lambda image: img.rotate_image(image, 30),
+    'flip': lambda image: img.flip_image(image, 1),
+    'adjust': lambda image: img.adjust_brightness_contrast(image, 10, 1.2),
+    'blur': lambda image: img.apply_blur(image, 7),
+    'crop': crop_copy,
+}
+
+# Operation name -> img command line arguments for the same work
+CLI_OPERATIONS = {
+    'resize': ['--operation', 'resize', '--scale', '0.5'],
+    'rotate': ['--operation', 'rotate', '--angle', '30'],
+    'flip': ['--operation', 'flip', '--flip-code', '1'],
+    'adjust': ['--operation', 'adjust', '--brightness', '10', '--contrast', '1.2'],
+    'blur': ['--operation', 'blur', '--kernel-size', '7'],
+    'crop': ['--operation', 'crop', '--x', '0', '--y', '0', '--crop-width', '64', '--crop-height', '64'],
+}
+
+def synthetic_image(width, height, channels, seed=0):
+    """Build a deterministic test image: smooth gradients with some noise, like a photo."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    planes = [x / width * 255, y / height * 255, (x + y) / (width + height) * 255, np.full_like(x, 255)]
+    image = np.dstack(planes[:channels]) + rng.normal(0, 12, (height, width, channels)).astype(np.float32)
+    image = np.clip(image, 0, 255).astype(np.uint8)
+    return image[:, :, 0] if channels == 1 else image
+
+def measure(function, min_runs=MIN_RUNS, min_time=MIN_TIME):
+    """Call function after one warm-up call until it ran min_runs times and for min_time seconds."""
+    function()
+    times = []
+    started = time.perf_counter()
+    while len(times) < min_runs or time.perf_counter() - started < min_time:
+        call_started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - call_started)
+    return times
+
+def summarize(times, megapixels):
+    """Percentiles of the call times and the throughput they correspond to."""
+    cuts = statistics.quantiles(times, n=100, method='inclusive')
+    p50, p90, p99 = statistics.median(times), cuts[89], cuts[98]
+    return {
+        "runs": len(times),
+        "min_ms": min(times) * 1000,
+        "p50_ms": p50 * 1000,
+        "p90_ms": p90 * 1000,
+        "p99_ms": p99 * 1000,
+        "mp_per_s_p50": megapixels / p50,
+        "mp_per_s_p90": megapixels / p90,
+    }
+
+def run_operations(operations, sizes, channel_counts, min_time):
+    """Benchmark each operation in-process on each synthetic image."""
+    results = []
+    for size in sizes:
+        width, height = SIZES[size]
+        for channels in channel_counts:
+            image = synthetic_image(width, height, channels)
+            for operation in operations:
+                times = measure(lambda: OPERATIONS[operation](image), min_time=min_time)
+                result = {"name": f"{operation}/{size}/{channels}ch", "operation": operation, "size": size,
+                          "width": width, "height": height, "channels": channels}
+                result.update(summarize(times, width * height / 1e6))
+                results.append(result)
+                print(f"{result['name']:<20} {result['p50_ms']:9.2f} ms  p90 {result['p90_ms']:9.2f} ms  "
+                      f"{result['mp_per_s_p50']:9.1f} MP/s  ({result['runs']} runs)")
+    return results
+
+def run_cli(command, operations, sizes, min_time):
+    """Time whole img runs on synthetic JPEGs, from process start to exit."""
+    results = []
+    # Builds from before the result cache reject --no-cache, so only pass it when the command knows it
+    usage = subprocess.run(command + ['--help'], capture_output=True, text=True).stdout
+    no_cache = ['--no-cache'] if '--no-cache' in usage else []
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, "out.jpg")
+        for size in sizes:
+            width, height = SIZES[size]
+            source = os.path.join(tmp, f"{size}.jpg")
+            cv2.imwrite(source, synthetic_image(width, height, 3))
+            for operation in operations:
+                args = command + ['-i', source, '-o', output] + no_cache + CLI_OPERATIONS[operation]
+
+                def run():
+                    subprocess.run(args, check=True, stdout=subprocess.DEVNULL)
+
+                times = measure(run, min_time=min_time)
+                result = {"name": f"cli/{operation}/{size}", "operation": operation, "size": size,
+                          "width": width, "height": height, "channels": 3}
+                result.update(summarize(times, width * height / 1e6))
+                results.append(result)
+                print(f"{result['name']:<20} {result['p50_ms']:9.2f} ms  p90 {result['p90_ms']:9.2f} ms  "
+                      f"({result['runs']} runs)")
+    return results
+
+def environment():
+    """Describe where the benchmark ran, so that results are only compared like for like."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "opencv_threads": cv2.getNumThreads(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+def compare(results, baseline_path, threshold):
+    """
+    Print how each median time changed against a saved run.
+
+    Returns:
+        Number of cases that got slower by more than threshold
+    """
+    with open(baseline_path, 'r') as f:
+        baseline = {result["name"]: result for result in json.load(f)["results"]}
+
+    print(f"\nCompared with {baseline_path}:")
+    regressions = 0
+    for result in results:
+        before = baseline.get(result["name"])
+        if before is None:
+            print(f"{result['name']:<20} new")
+            continue
+        change = result["p50_ms"] / before["p50_ms"] - 1
+        marker = ""
+        if change > threshold:
+            regressions += 1
+            marker = "  REGRESSION"
+        print(f"{result['name']:<20} {before['p50_ms']:9.2f} -> {result['p50_ms']:9.2f} ms  {change:+7.1%}{marker}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the image operations of img.py')
+    parser.add_argument('--operations', nargs='+', choices=list(OPERATIONS), default=list(OPERATIONS),
+                        help='Operations to benchmark (default: all)')
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=list(SIZES),
+                        help='Image sizes to benchmark (default: all)')
+    parser.add_argument('--channels', nargs='+', type=int, choices=CHANNELS, default=CHANNELS,
+                        help='Channel counts to benchmark in-process (default: all)')
+    parser.add_argument('--min-time', type=float, default=MIN_TIME,
+                        help=f'Seconds to repeat each case for, at least {MIN_RUNS} times (default: {MIN_TIME})')
+    parser.add_argument('--threads', type=int, help="OpenCV's thread count (default: OpenCV's own choice)")
+    parser.add_argument('--cli', action='store_true', help='Time whole runs of the img command line instead')
+    parser.add_argument('--command', nargs='+', help='img command to time with --cli (default: this python img.py)')
+    parser.add_argument('--json', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=COMPARE_THRESHOLD,
+                        help=f'Slowdown that fails --compare (default: {COMPARE_THRESHOLD} = '
+                             f'{COMPARE_THRESHOLD:.0%})')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        cv2.setNumThreads(args.threads)
+
+    if args.cli:
+        command = args.command or [sys.executable, IMG_SCRIPT]
+        results = run_cli(command, args.operations, args.sizes, args.min_time)
+    else:
+        results = run_operations(args.operations, args.sizes, args.channels, args.min_time)
+
+    if args.json:
+        report = {"mode": "cli" if args.cli else "operations", "environment": environment(), "results": results}
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,93 +1,96 @@
+"""Tests for back/pkgs/img.py. Run with: python3 -m pytest test_img.py"""
+import argparse
 import os
-import subprocess
-import numpy as np
-import cv2
+import sys
 
-# Create a test image
-test_image_path = 'test_image.jpg'
-test_output_path = 'test_output.jpg'
+import pytest
 
-# Create a simple test image (a gradient)
-width, height = 300, 200
-image = np.zeros((height, width, 3), dtype=np.uint8)
-for i in range(height):
-    for j in range(width):
-        image[i, j] = [i % 256, j % 256, (i + j) % 256]
-cv2.imwrite(test_image_path, image)
-print(f"Created test image: {test_image_path}")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "back", "pkgs"))
 
-# Test resize operation
-print("\nTesting resize operation...")
-subprocess.run(['python', 'back/pkgs/img.py', 
-                '-i', test_image_path, 
-                '-o', test_output_path, 
-                '--operation', 'resize', 
-                '--width', '150'])
-if os.path.exists(test_output_path):
-    resized_image = cv2.imread(test_output_path)
-    print(f"Resize successful. New dimensions: {resized_image.shape[1]}x{resized_image.shape[0]}")
-    os.remove(test_output_path)
+import img
 
-# Test crop operation
-print("\nTesting crop operation...")
-subprocess.run(['python', 'back/pkgs/img.py', 
-                '-i', test_image_path, 
-                '-o', test_output_path, 
-                '--operation', 'crop', 
-                '--x', '50', 
-                '--y', '50', 
-                '--crop-width', '100', 
-                '--crop-height', '100'])
-if os.path.exists(test_output_path):
-    cropped_image = cv2.imread(test_output_path)
-    print(f"Crop successful. New dimensions: {cropped_image.shape[1]}x{cropped_image.shape[0]}")
-    os.remove(test_output_path)
+img.load_imaging()
+np = img.np
 
-# Test rotate operation
-print("\nTesting rotate operation...")
-subprocess.run(['python', 'back/pkgs/img.py', 
-                '-i', test_image_path, 
-                '-o', test_output_path, 
-                '--operation', 'rotate', 
-                '--angle', '45'])
-if os.path.exists(test_output_path):
-    print("Rotation successful.")
-    os.remove(test_output_path)
+FUSED_PIPELINES = [
+    "crop:x=20,y=10,width=100,height=80,resize:scale=1.5",
+    "flip:code=1,resize:scale=1.5",
+    "resize:scale=1.5,flip:code=0",
+    "resize:scale=1.5,crop:x=5,y=5,width=120,height=90",
+    "flip:code=-1,resize:width=300,crop:x=0,y=0,width=50,height=50",
+    "crop:x=10,y=10,width=150,height=100,resize:scale=0.8,flip:code=1",
+]
 
-# Test flip operation
-print("\nTesting flip operation...")
-subprocess.run(['python', 'back/pkgs/img.py', 
-                '-i', test_image_path, 
-                '-o', test_output_path, 
-                '--operation', 'flip', 
-                '--flip-code', '1'])
-if os.path.exists(test_output_path):
-    print("Flip successful.")
-    os.remove(test_output_path)
+ROTATED_PIPELINES = [
+    "rotate:angle=30,rotate:angle=-30",
+    "rotate:angle=45,flip:code=1,rotate:angle=45",
+    "rotate:angle=20,resize:scale=1.5",
+    "crop:x=10,y=10,width=100,height=80,rotate:angle=30,resize:scale=1.2,rotate:angle=-15",
+    "rotate:angle=30,crop:x=10,y=10,width=100,height=80,rotate:angle=10",
+]
 
-# Test brightness/contrast adjustment
-print("\nTesting brightness/contrast adjustment...")
-subprocess.run(['python', 'back/pkgs/img.py', 
-                '-i', test_image_path, 
-                '-o', test_output_path, 
-                '--operation', 'adjust', 
-                '--brightness', '10', 
-                '--contrast', '1.2'])
-if os.path.exists(test_output_path):
-    print("Brightness/contrast adjustment successful.")
-    os.remove(test_output_path)
+def black_fraction(image):
+    return (image.max(axis=2) == 0).mean()
 
-# Test blur operation
-print("\nTesting blur operation...")
-subprocess.run(['python', 'back/pkgs/img.py', 
-                '-i', test_image_path, 
-                '-o', test_output_path, 
-                '--operation', 'blur', 
-                '--kernel-size', '7'])
-if os.path.exists(test_output_path):
-    print("Blur successful.")
-    os.remove(test_output_path)
+@pytest.mark.parametrize("spec", FUSED_PIPELINES)
+def test_fused_upscale_keeps_flat_edges(spec):
+    image = np.full((120, 160, 3), 200, dtype=np.uint8)
+    stages = img.parse_pipeline(spec)
+    fused = img.run_pipeline(image, stages)
+    unfused = img.run_pipeline(image, stages, fuse=False)
+    assert fused.shape == unfused.shape
+    assert fused.min() == fused.max() == 200
 
-# Clean up
-os.remove(test_image_path)
-print("\nAll tests completed successfully!")
\ No newline at end of file
+@pytest.mark.parametrize("spec", FUSED_PIPELINES + ROTATED_PIPELINES)
+def test_fused_matches_unfused(spec):
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:120, 0:160]
+    image = np.dstack([x, y, (x + y) // 2]).astype(np.uint8) + rng.integers(8, 16, (120, 160, 3), dtype=np.uint8)
+    stages = img.parse_pipeline(spec)
+    fused = img.run_pipeline(image, stages).astype(int)
+    unfused = img.run_pipeline(image, stages, fuse=False).astype(int)
+    assert fused.shape == unfused.shape
+    assert np.abs(fused - unfused).mean() < 2
+    # Corners clipped by a rotation stay black, as when the stages run one by one
+    assert abs(black_fraction(fused) - black_fraction(unfused)) < 0.01
+
+def test_job_task_checks_parameters(tmp_path):
+    allowed = (os.path.realpath(tmp_path),)
+    job = {"input": str(tmp_path / "in.png"), "output": str(tmp_path / "out.png"),
+           "stages": [["resize", {"width": "10"}], ["rotate", {"angle": 90}]]}
+    _, _, stages, _, _ = img.job_task(job, allowed_dirs=allowed)
+    assert stages == [("resize", {"width": 10}), ("rotate", {"angle": 90.0})]
+
+    for params in ({"width": "ten"}, {"width": True}, {"width": 1.5}, {"scale": "inf"}, {"width": [1]}):
+        with pytest.raises(ValueError):
+            img.job_task(dict(job, stages=[["resize", params]]), allowed_dirs=allowed)
+    with pytest.raises(ValueError):
+        img.job_task(dict(job, output="/etc/out.png"), allowed_dirs=allowed)
+
+def test_tiled_run_can_overwrite_its_input(tmp_path):
+    path = str(tmp_path / "image.ppm")
+    y, x = np.mgrid[0:64, 0:80]
+    image = np.dstack([x, y, x + y]).astype(np.uint8)
+    img.cv2.imwrite(path, image)
+    args = argparse.Namespace(input=path, output=path, max_memory="64K", jobs=2)
+    img.run_tiled(args, img.parse_pipeline("flip:code=1"))
+    assert np.array_equal(img.cv2.imread(path), image[:, ::-1])
+    assert os.listdir(tmp_path) == ["image.ppm"]
+
+def test_video_fails_when_a_stage_raises(tmp_path, monkeypatch):
+    for index in range(5):
+        img.cv2.imwrite(str(tmp_path / f"in_{index:03d}.png"), np.full((16, 16, 3), index * 40, dtype=np.uint8))
+    run_pipeline = img.run_pipeline
+    calls = []
+
+    def failing_pipeline(image, stages, timings=None, fuse=True):
+        calls.append(image)
+        if len(calls) == 3:
+            raise TypeError("stage failed")
+        return run_pipeline(image, stages, timings, fuse)
+
+    monkeypatch.setattr(img, "run_pipeline", failing_pipeline)
+    args = argparse.Namespace(input=str(tmp_path / "in_%03d.png"), output=str(tmp_path / "out_%03d.png"),
+                              fps=None, fourcc=None, queue_size=2)
+    with pytest.raises(TypeError):
+        img.run_video(args, img.parse_pipeline("flip:code=1"))
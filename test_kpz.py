@@ -0,0 +1,136 @@
+"""Tests for back/pkgs/kpz.py. Run with: python3 -m pytest test_kpz.py"""
+import gzip
+import hashlib
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "back", "pkgs"))
+
+import kpz
+
+PACKAGE = b"#!/bin/sh\necho hello\n" + os.urandom(256 * 1024)
+
+class TruncatingHandler(BaseHTTPRequestHandler):
+    """Serve a package in full, but drop the connection halfway through its gzip copy."""
+    def do_GET(self):
+        if self.path == "/tool.gz":
+            body = gzip.compress(PACKAGE)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(PACKAGE)))
+        self.end_headers()
+        self.wfile.write(PACKAGE)
+
+    def log_message(self, format, *args):
+        pass
+
+def test_truncated_compressed_download_falls_back(tmp_path, monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), TruncatingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        monkeypatch.setattr(kpz, "SERVER_URL", f"http://127.0.0.1:{server.server_port}")
+        monkeypatch.setattr(kpz, "BIN_DIR", str(tmp_path / "bin"))
+        monkeypatch.setattr(kpz, "CACHE_DIR", str(tmp_path / "cache"))
+        os.makedirs(kpz.BIN_DIR)
+        os.makedirs(kpz.CACHE_DIR)
+        expected = {"sha256": hashlib.sha256(PACKAGE).hexdigest(), "size": len(PACKAGE),
+                    "encodings": {"gzip": {"path": "tool.gz"}}}
+
+        with requests.Session() as session:
+            result = kpz.fetch_package(session, "tool", expected=expected)
+
+        assert result["source"] == "download"
+        assert result["encoding"] is None
+        with open(os.path.join(kpz.BIN_DIR, "tool"), 'rb') as f:
+            assert f.read() == PACKAGE
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def use_bin_dir(monkeypatch, tmp_path):
+    bin_dir = str(tmp_path / "bin")
+    os.makedirs(bin_dir)
+    monkeypatch.setattr(kpz, "BIN_DIR", bin_dir)
+    for constant, name in (("INSTALLED_FILE", "installed.json"), ("LOCK_FILE", ".kpz.lock"),
+                           ("MANIFEST_FILE", "manifest.json"), ("REGISTRY_FILE", "registry.txt"),
+                           ("HTTP_CACHE_FILE", "http-cache.json"), ("ONEDIR_DIR", ".onedir")):
+        monkeypatch.setattr(kpz, constant, os.path.join(bin_dir, name))
+    monkeypatch.setenv("PATH", bin_dir + os.pathsep + os.environ.get("PATH", ""))
+    return bin_dir
+
+def test_remove_all_skips_packages_removed_with_their_bundle(tmp_path, monkeypatch, capsys):
+    bin_dir = use_bin_dir(monkeypatch, tmp_path)
+    with open(os.path.join(bin_dir, "kpzbox"), 'wb') as f:
+        f.write(PACKAGE)
+    with kpz.installed_transaction() as installed:
+        installed["kpzbox"] = {"sha256": "0" * 64, "size": len(PACKAGE)}
+        kpz.link_bundle(installed, "kpzbox", ["img", "qr"])
+
+    kpz.remove(["all"])
+
+    output = capsys.readouterr().out
+    assert "not installed" not in output
+    assert kpz.load_installed() == {}
+    assert not {"kpzbox", "img", "qr"} & set(os.listdir(bin_dir))
+
+def test_bundle_link_replaces_fast_start_install(tmp_path, monkeypatch):
+    bin_dir = use_bin_dir(monkeypatch, tmp_path)
+    version_dir = os.path.join(kpz.ONEDIR_DIR, "img-000000000000")
+    os.makedirs(os.path.join(version_dir, "img"))
+    with open(os.path.join(bin_dir, "kpzbox"), 'wb') as f:
+        f.write(PACKAGE)
+    with kpz.installed_transaction() as installed:
+        installed["kpzbox"] = {"sha256": "0" * 64, "size": len(PACKAGE)}
+        installed["img"] = {"sha256": "1" * 64, "size": 1, "onedir": os.path.relpath(version_dir, bin_dir)}
+        kpz.link_bundle(installed, "kpzbox", ["img"])
+
+    assert not os.path.exists(version_dir)
+    assert kpz.load_installed()["img"]["bundle"] == "kpzbox"
+
+def test_session_pool_grows_for_more_jobs(monkeypatch):
+    monkeypatch.setattr(kpz, "_session", None)
+    monkeypatch.setattr(kpz, "_session_pool_size", 0)
+    session = kpz.get_session()
+    assert kpz.get_session(8) is session
+    assert session.get_adapter("http://localhost")._pool_maxsize == 8
+    kpz.get_session(2)
+    assert session.get_adapter("http://localhost")._pool_maxsize == 8
+
+def test_switching_to_a_cached_build_counts_as_upgraded(tmp_path, monkeypatch, capsys):
+    bin_dir = use_bin_dir(monkeypatch, tmp_path)
+    monkeypatch.setattr(kpz, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(kpz, "CACHE_INDEX_FILE", str(tmp_path / "cache" / "index.json"))
+    sha = hashlib.sha256(PACKAGE).hexdigest()
+    os.makedirs(os.path.dirname(kpz.cache_object_path(sha)))
+    with open(kpz.cache_object_path(sha), 'wb') as f:
+        f.write(PACKAGE)
+    with open(os.path.join(bin_dir, "tool"), 'wb') as f:
+        f.write(b"old build")
+    with kpz.installed_transaction() as installed:
+        installed["tool"] = {"sha256": "0" * 64, "size": 9}
+    manifest = {"packages": {"tool": {"sha256": sha, "size": len(PACKAGE)}}}
+
+    kpz.download_packages(["tool"], action="upgrade", manifest=manifest)
+
+    assert "1 upgraded, 0 up to date" in capsys.readouterr().out
+    assert kpz.load_installed()["tool"]["sha256"] == sha
+
+def test_upgrade_skips_links_whose_bundle_is_not_installed(tmp_path, monkeypatch, capsys):
+    use_bin_dir(monkeypatch, tmp_path)
+    with kpz.installed_transaction() as installed:
+        installed["img"] = {"sha256": "1" * 64, "size": 1, "bundle": "kpzbox"}
+        installed["qr"] = {"sha256": "1" * 64, "size": 1, "bundle": "kpzbox"}
+    monkeypatch.setattr(kpz, "get_manifest", lambda: {"packages": {"kpzbox": {}}})
+
+    assert kpz.upgrade()
+    assert capsys.readouterr().out.count("Package 'kpzbox' is not installed.") == 1